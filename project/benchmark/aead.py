@@ -0,0 +1,79 @@
+"""
+Compares AES-GCM and HKDF of crypto_utils with the previous implementation, which created a Cipher or HKDF object
+of cryptography for every call. Small messages measure the latency of one call, bulk messages the throughput.
+Run with `python -m project.benchmark.aead` from the root directory of the project.
+"""
+import os
+import timeit
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from project.util import crypto_utils
+
+SMALL_MESSAGE = 64
+BULK_MESSAGES = 1000
+BULK_MESSAGE = 1024
+ITERATIONS = 10_000
+
+
+def cipher_encrypt(key: bytes, plaintext: bytes, associated_data: bytes) -> tuple[bytes, bytes, bytes]:
+    iv = os.urandom(12)
+    encryptor = Cipher(algorithms.AES(key), modes.GCM(iv)).encryptor()
+    encryptor.authenticate_additional_data(associated_data)
+    ciphertext = encryptor.update(plaintext) + encryptor.finalize()
+    return iv, ciphertext, encryptor.tag
+
+
+def cipher_decrypt(key: bytes, iv: bytes, ciphertext: bytes, associated_data: bytes, tag: bytes) -> bytes:
+    decryptor = Cipher(algorithms.AES(key), modes.GCM(iv, tag)).decryptor()
+    decryptor.authenticate_additional_data(associated_data)
+    return decryptor.update(ciphertext) + decryptor.finalize()
+
+
+def hkdf_object(salt: bytes, input_key_material: bytes, length: int) -> bytes:
+    return HKDF(algorithm=SHA256(), length=length, salt=salt, info=None).derive(input_key_material)
+
+
+def microseconds(function, number: int = ITERATIONS) -> float:
+    return timeit.timeit(function, number=number) / number * 1e6
+
+
+def main():
+    key = os.urandom(32)
+    small = os.urandom(SMALL_MESSAGE)
+    iv, ciphertext, tag = cipher_encrypt(key, small, b"AD")
+    assert crypto_utils.aes_gcm_decrypt(key, iv, ciphertext, b"AD", tag) == small
+
+    print(f"small messages ({SMALL_MESSAGE} bytes), us per call:")
+    print(f"  {'Cipher':<16} encrypt {microseconds(lambda: cipher_encrypt(key, small, b'AD')):>6.1f}   "
+          f"decrypt {microseconds(lambda: cipher_decrypt(key, iv, ciphertext, b'AD', tag)):>6.1f}")
+    print(f"  {'AESGCM':<16} encrypt {microseconds(lambda: crypto_utils.aes_gcm_encrypt(key, small, b'AD')):>6.1f}   "
+          f"decrypt {microseconds(lambda: crypto_utils.aes_gcm_decrypt(key, iv, ciphertext, b'AD', tag)):>6.1f}")
+
+    # Every message has its own key, like the message keys of the double ratchet
+    bulk = [(os.urandom(32), None, os.urandom(BULK_MESSAGE), b"AD") for _ in range(BULK_MESSAGES)]
+    encrypted = [crypto_utils.aes_gcm_encrypt(key, plaintext, ad) for key, _, plaintext, ad in bulk]
+    decrypt_bulk = [(key, iv, ciphertext, ad, tag) for (key, _, _, ad), (iv, ciphertext, tag) in zip(bulk, encrypted)]
+    assert [crypto_utils.aes_gcm_decrypt(*message) for message in decrypt_bulk] == [plaintext for _, _, plaintext, _ in bulk]
+
+    megabytes = BULK_MESSAGES * BULK_MESSAGE / 1024 / 1024
+    print(f"bulk messages ({BULK_MESSAGES} x {BULK_MESSAGE} bytes), MB/s:")
+    loop_encrypt = microseconds(lambda: [cipher_encrypt(key, plaintext, ad) for key, _, plaintext, ad in bulk], 20)
+    loop_decrypt = microseconds(lambda: [cipher_decrypt(key, iv, c, ad, tag) for key, iv, c, ad, tag in decrypt_bulk], 20)
+    aesgcm_encrypt = microseconds(lambda: [crypto_utils.aes_gcm_encrypt(key, plaintext, ad) for key, _, plaintext, ad in bulk], 20)
+    aesgcm_decrypt = microseconds(lambda: [crypto_utils.aes_gcm_decrypt(*message) for message in decrypt_bulk], 20)
+    print(f"  {'Cipher loop':<16} encrypt {megabytes / loop_encrypt * 1e6:>6.1f}   decrypt {megabytes / loop_decrypt * 1e6:>6.1f}")
+    print(f"  {'AESGCM loop':<16} encrypt {megabytes / aesgcm_encrypt * 1e6:>6.1f}   decrypt {megabytes / aesgcm_decrypt * 1e6:>6.1f}")
+
+    chain_key = os.urandom(64)
+    for salt in [None, b"", os.urandom(32)]:
+        assert crypto_utils.hkdf_extract(salt, chain_key, 64) == hkdf_object(salt, chain_key, 64)
+    print("HKDF (64 bytes), us per call:")
+    print(f"  {'HKDF object':<16} {microseconds(lambda: hkdf_object(b'', chain_key, 64)):>6.1f}")
+    print(f"  {'hmac':<16} {microseconds(lambda: crypto_utils.hkdf_extract(b'', chain_key, 64)):>6.1f}")
+
+
+if __name__ == "__main__":
+    main()
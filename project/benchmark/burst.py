@@ -0,0 +1,69 @@
+"""
+Measures the throughput of sending and receiving bursts of 10, 100 and 1000 chat messages to one user.
+One by one: every message is encrypted, encoded, framed and saved on its own (the previous behaviour).
+Batched: the burst is encrypted with encrypt_many, sent in one frame and saved once.
+The chats are saved to an EncryptedDatabase which writes every save to disk. The client writes saves in batches,
+which makes the difference smaller there.
+Run with `python -m project.benchmark.burst` from the root directory of the project.
+"""
+import os
+import tempfile
+import time
+
+from project.util import crypto_utils
+from project.util.database import EncryptedDatabase, DURABILITY_ALWAYS
+from project.util.framing import FrameBuffer, frame
+from project.util.message import Message
+from project.util.ratchet import DoubleRatchetState
+from project.util.serializer.serializer import encode_message
+
+BURST_SIZES = [10, 100, 1000]
+
+
+def create_chats() -> tuple[DoubleRatchetState, DoubleRatchetState]:
+    root_key = os.urandom(32)
+    y, Y = crypto_utils.generate_signature_key_pair()
+    return DoubleRatchetState(root_key, None, None, Y), DoubleRatchetState(root_key, y, Y, None, initialized_by_me=False)
+
+
+def one_by_one(sender: DoubleRatchetState, receiver: DoubleRatchetState, database: EncryptedDatabase, plaintexts: list[bytes]) -> float:
+    start = time.perf_counter()
+    buffer = FrameBuffer()
+    for plaintext in plaintexts:
+        message = Message(encode_message(sender.encrypt(plaintext)), "alice", "bob")
+        database.save("chats")
+        for received in buffer.feed(frame(message.to_bytes())):
+            receiver.decrypt(Message.from_bytes(received).dict())
+            database.save("chats")
+    return time.perf_counter() - start
+
+
+def batched(sender: DoubleRatchetState, receiver: DoubleRatchetState, database: EncryptedDatabase, plaintexts: list[bytes]) -> float:
+    start = time.perf_counter()
+    buffer = FrameBuffer()
+    message = Message(encode_message({"messages": sender.encrypt_many(plaintexts)}), "alice", "bob")
+    database.save("chats")
+    for received in buffer.feed(frame(message.to_bytes())):
+        receiver.decrypt_many(Message.from_bytes(received).dict()["messages"])
+        database.save("chats")
+    return time.perf_counter() - start
+
+
+def main():
+    print(f"{'burst':>6} {'one by one':>16} {'batched':>16}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in BURST_SIZES:
+            plaintexts = [f"Message number {i} of the burst".encode() for i in range(size)]
+            results = []
+            for send in [one_by_one, batched]:
+                sender, receiver = create_chats()
+                database = EncryptedDatabase(os.path.join(directory, f"{send.__name__}-{size}.json"),
+                                             os.path.join(directory, "key.txt"), durability=DURABILITY_ALWAYS)
+                database.insert("chats", {"alice": sender, "bob": receiver})
+                results.append(size / send(sender, receiver, database, plaintexts))
+                database.close()
+            print(f"{size:>6} {results[0]:>10.0f} msg/s {results[1]:>10.0f} msg/s")
+
+
+if __name__ == "__main__":
+    main()
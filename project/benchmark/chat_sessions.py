@@ -0,0 +1,83 @@
+"""
+Measures opening a client database with 10k chats, sending a message in 100 of them and writing the changes,
+with all chats in one entry of the database (the old layout) and with one file per chat behind ChatSessions.
+Run with `python -m project.benchmark.chat_sessions` from the root directory of the project.
+"""
+import os
+import tempfile
+import time
+import tracemalloc
+
+from project.client.chat_sessions import ChatSessions
+from project.util import crypto_utils
+from project.util.database import EncryptedDatabase, DURABILITY_PERIODIC
+from project.util.ratchet import DoubleRatchetState
+
+CHATS = 10_000
+ACTIVE_CHATS = 100
+
+
+def create_database(directory: str) -> tuple[str, str]:
+    paths = os.path.join(directory, "database.encrypted.json"), os.path.join(directory, "key.txt")
+    # Generating keys is slow with ecdsa, so all chats share the same keys
+    _, Y = crypto_utils.generate_signature_key_pair()
+    database = EncryptedDatabase(*paths, durability=DURABILITY_PERIODIC)
+    database.insert("chats", {f"user{i}": DoubleRatchetState(os.urandom(32), None, None, Y) for i in range(CHATS)})
+    database.close()
+    return paths
+
+
+def chats_path(paths: tuple[str, str]) -> str:
+    return os.path.join(os.path.dirname(paths[0]), "chats")
+
+
+def use_chats(paths: tuple[str, str], per_chat: bool, trace: bool = False) -> tuple[float, float, float, int]:
+    """Opens the database, sends a message in every active chat and saves the chats."""
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    database = EncryptedDatabase(*paths, durability=DURABILITY_PERIODIC)
+    chats = ChatSessions(chats_path(paths), database.encryption_key, ACTIVE_CHATS, DURABILITY_PERIODIC) if per_chat else None
+    opened = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(ACTIVE_CHATS):
+        drs = chats.get(f"user{i}") if per_chat else database.get("chats").get(f"user{i}")
+        drs.encrypt(b"Hello")
+        if per_chat:
+            chats.save(f"user{i}", drs)
+        else:
+            database.save("chats")
+    used = time.perf_counter() - start
+
+    start = time.perf_counter()
+    chats.flush() if per_chat else database.flush()
+    flushed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0] if trace else 0
+    if trace:
+        tracemalloc.stop()
+    if per_chat:
+        chats.close()
+    database.close()
+    return opened, used, flushed, memory
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        paths = create_database(directory)
+        one_entry = use_chats(paths, False)[:3] + use_chats(paths, False, True)[3:]
+        # The first open moves the chats into their own files and writes the database without them
+        database = EncryptedDatabase(*paths)
+        ChatSessions(chats_path(paths), database.encryption_key).migrate(database)
+        database.compact()
+        database.close()
+        per_chat = use_chats(paths, True)[:3] + use_chats(paths, True, True)[3:]
+
+    print(f"{CHATS} chats, a message is sent in {ACTIVE_CHATS} of them")
+    for name, (opened, used, flushed, memory) in [("one entry", one_entry), ("per chat", per_chat)]:
+        print(f"  {name:<10} open {opened * 1000:>7.1f} ms   send {used * 1000:>6.1f} ms   "
+              f"write {flushed * 1000:>6.1f} ms   memory {memory / 1024 / 1024:>5.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Compares the compression modes of a connection on a typical sequence of frames:
+registration, login, a key exchange and a chat with many messages.
+Run with `python -m project.benchmark.compression` from the root directory of the project.
+"""
+import os
+import time
+import zlib
+
+from project.util import compression, crypto_utils, x3dh_utils
+from project.util.compression import StreamCompressor, StreamDecompressor
+from project.util.framing import MAX_FRAME_SIZE
+from project.util.message import Message, REGISTER, STATUS, LOGIN, REQUEST_SALT, ANSWER_SALT, X3DH_BUNDLE_REQUEST, X3DH_FORWARD, \
+    MESSAGE, NOT_REGISTERED, SUCCESS
+from project.util.ratchet import DoubleRatchetState
+from project.util.serializer.serializer import encode_message
+
+
+def frame(sender: str, receiver: str, content: dict, type: str) -> bytes:
+    return Message(encode_message(content), sender, receiver, type).to_bytes()
+
+
+def workload(messages: int = 200) -> list[bytes]:
+    keys = x3dh_utils.generate_initial_x3dh_keys()
+    frames = [
+        frame("server", "alice", {"status": NOT_REGISTERED}, STATUS),
+        frame("alice", "server", {"password": "password", "keys": {
+            "IPK": keys["IPK"], "SPK": keys["SPK"], "OPKs": keys["OPKs"], "sigma": keys["sigma"]
+        }}, REGISTER),
+        frame("server", "alice", {"status": SUCCESS, "salt": os.urandom(32), "pepper": os.urandom(32)}, REGISTER),
+        frame("alice", "server", {}, REQUEST_SALT),
+        frame("server", "alice", {"salt": os.urandom(32)}, ANSWER_SALT),
+        frame("alice", "server", {"salted_password": os.urandom(32)}, LOGIN),
+        frame("server", "alice", {"status": SUCCESS}, LOGIN),
+        frame("server", "alice", {"status": SUCCESS, "owner": "bob", "key_bundle": {
+            "IPK": keys["IPK"], "SPK": keys["SPK"], "OPK": keys["OPKs"][0], "sigma": keys["sigma"]
+        }}, X3DH_BUNDLE_REQUEST),
+        frame("alice", "server", {
+            "target": "bob", "IPK": keys["IPK"], "EPK": keys["OPKs"][1], "SPK": keys["SPK"],
+            "iv": os.urandom(12), "cipher": os.urandom(5), "tag": os.urandom(16)
+        }, X3DH_FORWARD)
+    ]
+    drs = DoubleRatchetState(os.urandom(32), None, None, keys["SPK"])
+    for i in range(messages):
+        frames.append(frame("alice", "bob", drs.encrypt(f"Message number {i}, how are you doing?".encode()), MESSAGE))
+    return frames
+
+
+def measure_per_message(frames: list[bytes]) -> tuple[int, float, float]:
+    # Every payload compressed on its own with a fresh zlib stream, like the old serializer did
+    start = time.perf_counter()
+    compressed = [zlib.compress(payload) for payload in frames]
+    compress_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for payload in compressed:
+        zlib.decompress(payload)
+    return sum(len(payload) for payload in compressed), compress_time, time.perf_counter() - start
+
+
+def measure_stream(frames: list[bytes], mode: str) -> tuple[int, float, float]:
+    compressor = StreamCompressor(mode)
+    decompressor = StreamDecompressor(mode)
+    start = time.perf_counter()
+    compressed = [compressor.compress(payload) for payload in frames]
+    compress_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for payload in compressed:
+        if payload is not None:
+            decompressor.decompress(payload, MAX_FRAME_SIZE)
+    size = sum(len(original if payload is None else payload) for original, payload in zip(frames, compressed))
+    return size, compress_time, time.perf_counter() - start
+
+
+def main():
+    frames = workload()
+    total = sum(len(payload) for payload in frames)
+    print(f"{len(frames)} frames, {total} bytes uncompressed")
+    results = [
+        (compression.NONE, (total, 0.0, 0.0)),
+        ("zlib per message", measure_per_message(frames)),
+        (compression.ZLIB, measure_stream(frames, compression.ZLIB)),
+        (compression.ZLIB_DICT, measure_stream(frames, compression.ZLIB_DICT))
+    ]
+    for name, (size, compress_time, decompress_time) in results:
+        print(f"  {name:<18} {size:>8} bytes   ratio {size / total:.2f}   "
+              f"compress {compress_time * 1000:>7.2f} ms   decompress {decompress_time * 1000:>7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
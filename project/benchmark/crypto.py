@@ -0,0 +1,38 @@
+"""
+Compares the elliptic curve operations of the crypto providers: key generation, DH, X3DH (four DHs), signing and verifying.
+Run with `python -m project.benchmark.crypto` from the root directory of the project.
+"""
+import timeit
+
+from project.util import crypto_utils, x3dh_utils
+from project.util.crypto_provider import PROVIDERS
+
+ITERATIONS = 200
+
+
+def operations_per_second(function) -> float:
+    return ITERATIONS / timeit.timeit(function, number=ITERATIONS)
+
+
+def main():
+    print(f"{'provider':<14} {'keygen/s':>10} {'DH/s':>10} {'X3DH/s':>10} {'sign/s':>10} {'verify/s':>10}")
+    for name in PROVIDERS:
+        crypto_utils.set_provider(name)
+        ik, IPK = crypto_utils.generate_signature_key_pair()
+        sk, SPK = crypto_utils.generate_signature_key_pair()
+        ok, OPK = crypto_utils.generate_signature_key_pair()
+        ek, EPK = crypto_utils.generate_signature_key_pair()
+        signature = crypto_utils.ecdsa_sign(b"message", ik)
+
+        results = [
+            operations_per_second(crypto_utils.generate_signature_key_pair),
+            operations_per_second(lambda: crypto_utils.power_sk_vk(ek, SPK)),
+            operations_per_second(lambda: x3dh_utils.x3dh_key(ik, ek, IPK, SPK, OPK)),
+            operations_per_second(lambda: crypto_utils.ecdsa_sign(b"message", ik)),
+            operations_per_second(lambda: crypto_utils.ecdsa_verify(signature, b"message", IPK))
+        ]
+        print(f"{name:<14} " + " ".join(f"{result:>10.0f}" for result in results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Measures logging in with 1k, 10k and 50k offline messages: how long the login takes and how long it takes until
+the client received all messages, with and without acknowledged pages.
+The client is a socket pair in the same process, which acknowledges pages like Client does.
+Run with `python -m project.benchmark.offline_delivery` from the root directory of the project.
+"""
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from project.server.handler import login_handler
+from project.server.server import Server
+from project.util import x3dh_utils
+from project.util.framing import FramedSocket
+from project.util.message import Message, LOGIN, MESSAGE, OFFLINE_ACK
+from project.util.serializer import serializer
+
+MESSAGE_COUNTS = [1_000, 10_000, 50_000]
+
+
+def fill_backlog(server: Server, username: str, messages: int):
+    keys = x3dh_utils.generate_initial_x3dh_keys()
+    key_bundle = {"IPK": keys["IPK"], "SPK": keys["SPK"], "OPKs": keys["OPKs"], "sigma": keys["sigma"]}
+    server.storage.register(username, b"password", key_bundle)
+    message = Message(serializer.encode_message({"ciphertext": os.urandom(200)}), "alice", username).to_bytes()
+    for _ in range(messages - 1):
+        server.storage.add_offline_message(username, message)
+    server.storage.add_offline_message(username, message).result()
+
+
+def receive(server: Server, client: FramedSocket, connection: FramedSocket, addr: tuple[str, int], username: str,
+            messages: int, done: threading.Event):
+    received = 0
+    while received < messages:
+        for frame in client.recv_frames():
+            message = Message.from_bytes(frame)
+            if message.type == MESSAGE:
+                received += 1
+            elif message.type == OFFLINE_ACK:
+                ack = Message(serializer.encode_message(message.dict()), username, "server", OFFLINE_ACK)
+                server.handle_bytes(ack.to_bytes(), connection, addr, username)
+    done.set()
+
+
+def log_in(server: Server, username: str, messages: int, acknowledges: bool) -> tuple[float, float]:
+    server_end, client_end = socket.socketpair()
+    connection, client = FramedSocket(server_end), FramedSocket(client_end)
+    addr = ("localhost", 1)
+    server.connections[username] = addr
+    server.sockets[addr] = connection
+    if acknowledges:
+        server.delivery.acknowledging.add(username)
+
+    done = threading.Event()
+    threading.Thread(target=receive, args=(server, client, connection, addr, username, messages, done), daemon=True).start()
+    login = Message(serializer.encode_message({"salted_password": b"password"}), username, "server", LOGIN)
+    login.raw = login.to_bytes()
+
+    start = time.perf_counter()
+    login_handler.handle_login(server, Message.from_bytes(login.raw), connection, addr)
+    logged_in = time.perf_counter() - start
+    done.wait()
+    delivered = time.perf_counter() - start
+
+    server.close_client(connection, addr)
+    client.close()
+    return logged_in, delivered
+
+
+def main():
+    counts = [int(count) for count in sys.argv[1:]] or MESSAGE_COUNTS
+    root = os.getcwd()
+    print(f"{'messages':>8} {'acks':>5} {'login':>10} {'delivered':>12} {'messages/s':>11}")
+    for messages in counts:
+        for acknowledges in (True, False):
+            with tempfile.TemporaryDirectory() as directory:
+                os.chdir(directory)
+                try:
+                    server = Server()
+                    username = "bob"
+                    fill_backlog(server, username, messages)
+                    logged_in, delivered = log_in(server, username, messages, acknowledges)
+                    server.delivery.close()
+                    server.storage.close()
+                    server.database.close()
+                    server.peppers.close()
+                finally:
+                    os.chdir(root)
+            print(f"{messages:>8} {'yes' if acknowledges else 'no':>5} {logged_in * 1000:>7.1f} ms {delivered * 1000:>9.1f} ms "
+                  f"{messages / delivered:>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
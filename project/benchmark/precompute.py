@@ -0,0 +1,52 @@
+"""
+Measures the precomputed multiplication tables of the ecdsa provider for the long-lived keys of a peer.
+Every handshake verifies the signature of the peer's SPK and computes the X3DH key, both with and without tables.
+Run with `python -m project.benchmark.precompute` from the root directory of the project.
+"""
+import time
+import timeit
+import tracemalloc
+
+from project.util import crypto_utils, x3dh_utils
+from project.util.crypto_provider import PrecomputeCache
+
+HANDSHAKES = 50
+
+
+def handshake(ik, IPK_B, SPK_B, OPK_B, sigma, precompute: bool):
+    ek, _ = crypto_utils.generate_signature_key_pair()
+    if precompute:
+        IPK_B, SPK_B = crypto_utils.precompute(IPK_B), crypto_utils.precompute(SPK_B)
+    assert crypto_utils.ecdsa_verify(sigma, crypto_utils.public_key_pem(SPK_B), IPK_B)
+    x3dh_utils.x3dh_key(ik, ek, IPK_B, SPK_B, OPK_B)
+
+
+def main():
+    crypto_utils.set_provider("ecdsa")
+    ik, _ = crypto_utils.generate_signature_key_pair()
+    ik_B, IPK_B = crypto_utils.generate_signature_key_pair()
+    _, SPK_B = crypto_utils.generate_signature_key_pair()
+    _, OPK_B = crypto_utils.generate_signature_key_pair()
+    sigma = crypto_utils.ecdsa_sign(crypto_utils.public_key_pem(SPK_B), ik_B)
+
+    cache = PrecomputeCache(threshold=1)
+    build = timeit.timeit(lambda: (cache.clear(), cache.get(IPK_B)), number=10) / 10
+    tracemalloc.start()
+    cache.clear()
+    cache.get(IPK_B)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"building a table: {build * 1000:.1f} ms, {memory / 1024:.0f} KB")
+
+    for precompute in [False, True]:
+        crypto_utils.provider.precomputed.clear()
+        start = time.perf_counter()
+        handshake(ik, IPK_B, SPK_B, OPK_B, sigma, precompute)
+        first = time.perf_counter() - start
+        repeated = timeit.timeit(lambda: handshake(ik, IPK_B, SPK_B, OPK_B, sigma, precompute), number=HANDSHAKES) / HANDSHAKES
+        print(f"{'precomputed' if precompute else 'plain':<12} handshakes/s {1 / repeated:>6.0f}   "
+              f"first handshake {first * 1000:>5.1f} ms   repeated {repeated * 1000:>5.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
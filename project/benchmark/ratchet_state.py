@@ -0,0 +1,69 @@
+"""
+Compares the old encoding of ratchet states (to_dict inside the binary format, every key decoded on load)
+with the binary layout of to_bytes, which keeps the keys as raw bytes until they are used.
+Measures the size, the time to save and load 1k and 10k chats and the memory of the loaded chats.
+Run with `python -m project.benchmark.ratchet_state` from the root directory of the project.
+"""
+import os
+import time
+import tracemalloc
+
+from project.util import crypto_utils
+from project.util.ratchet import DoubleRatchetState
+from project.util.serializer import binary_serializer
+
+CHAT_COUNTS = [1_000, 10_000]
+
+
+def create_chats(count: int) -> list[DoubleRatchetState]:
+    # Generating keys is slow with ecdsa, so all chats share the same keys
+    x, X = crypto_utils.generate_signature_key_pair()
+    _, Y = crypto_utils.generate_signature_key_pair()
+    chats = []
+    for _ in range(count):
+        drs = DoubleRatchetState(os.urandom(32), x, X, Y)
+        drs.index = 42
+        chats.append(drs)
+    return chats
+
+
+def measure(chats: list[DoubleRatchetState], encode, decode) -> tuple[int, float, float, float, int]:
+    # The first save encodes the keys, later saves reuse them until the keys change
+    start = time.perf_counter()
+    encoded = [encode(drs) for drs in chats]
+    first_save = time.perf_counter() - start
+    start = time.perf_counter()
+    encoded = [encode(drs) for drs in chats]
+    save = time.perf_counter() - start
+
+    start = time.perf_counter()
+    loaded = [decode(data) for data in encoded]
+    load = time.perf_counter() - start
+
+    del loaded
+    tracemalloc.start()
+    loaded = [decode(data) for data in encoded]
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert loaded[0].to_dict() == chats[0].to_dict()
+    return sum(len(data) for data in encoded), first_save, save, load, memory
+
+
+def main():
+    formats = {
+        "dict": (lambda drs: binary_serializer.encode(drs.to_dict()), lambda data: DoubleRatchetState.from_dict(binary_serializer.decode(data))),
+        "binary": (DoubleRatchetState.to_bytes, DoubleRatchetState.from_bytes)
+    }
+    print(f"{'chats':>6} {'format':<7} {'bytes/chat':>10} {'first save':>11} {'save':>10} {'load':>10} {'memory':>10}")
+    for count in CHAT_COUNTS:
+        for name, (encode, decode) in formats.items():
+            # States cache their encoded keys, so every format gets new states
+            chats = create_chats(count)
+            # Decoded public keys are cached, so the shared public keys are only parsed once in both formats
+            crypto_utils.decode_public_key.cache_clear()
+            size, first_save, save, load, memory = measure(chats, encode, decode)
+            print(f"{count:>6} {name:<7} {size / count:>10.0f} {first_save * 1000:>8.1f} ms {save * 1000:>7.1f} ms {load * 1000:>7.1f} ms {memory / 1024 / 1024:>7.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
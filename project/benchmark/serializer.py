@@ -0,0 +1,71 @@
+"""
+Compares the wire size and the encode/decode time of the old JSON + hex + zlib format and the binary format.
+Run with `python -m project.benchmark.serializer` from the root directory of the project.
+"""
+import os
+import timeit
+
+from project.util import crypto_utils
+from project.util.message import Message, MESSAGE, X3DH_FORWARD
+from project.util.ratchet import DoubleRatchetState
+from project.util.serializer.serializer import encode_message, decode_message, encode_legacy_message, decode_legacy_message
+
+ITERATIONS = 2000
+
+
+def legacy_frame(content: dict, sender: str, receiver: str, type: str) -> bytes:
+    # Messages used to be one encoded dictionary with the encoded content nested inside
+    return encode_legacy_message({"content": encode_legacy_message(content), "sender": sender, "receiver": receiver, "type": type})
+
+
+def legacy_decode(data: bytes) -> dict:
+    return decode_legacy_message(decode_legacy_message(data)["content"])
+
+
+def binary_frame(content: dict, sender: str, receiver: str, type: str) -> bytes:
+    return Message(encode_message(content), sender, receiver, type).to_bytes()
+
+
+def binary_decode(data: bytes) -> dict:
+    return Message.from_bytes(data).dict()
+
+
+def measure(name: str, content: dict, type: str):
+    legacy = legacy_frame(content, "alice", "bob", type)
+    binary = binary_frame(content, "alice", "bob", type)
+    assert legacy_decode(legacy).keys() == binary_decode(binary).keys()
+
+    print(f"{name}:")
+    for format_name, encoded, encode, decode in [
+        ("legacy", legacy, legacy_frame, legacy_decode),
+        ("binary", binary, binary_frame, binary_decode)
+    ]:
+        encode_time = timeit.timeit(lambda: encode(content, "alice", "bob", type), number=ITERATIONS) / ITERATIONS
+        decode_time = timeit.timeit(lambda: decode(encoded), number=ITERATIONS) / ITERATIONS
+        print(f"  {format_name:<8} {len(encoded):>6} bytes   encode {encode_time * 1e6:>8.1f} us   decode {decode_time * 1e6:>8.1f} us")
+
+
+def main():
+    _, Y = crypto_utils.generate_signature_key_pair()
+    drs = DoubleRatchetState(os.urandom(32), None, None, Y)
+    measure("MESSAGE (100 byte plaintext)", drs.encrypt(os.urandom(100)), MESSAGE)
+    measure("MESSAGE (4 KiB plaintext)", drs.encrypt(os.urandom(4096)), MESSAGE)
+
+    _, IPK = crypto_utils.generate_signature_key_pair()
+    _, EPK = crypto_utils.generate_signature_key_pair()
+    _, SPK = crypto_utils.generate_signature_key_pair()
+    iv, cipher, tag = crypto_utils.aes_gcm_encrypt(os.urandom(32), b"alice", crypto_utils.public_key_pem(IPK) + crypto_utils.public_key_pem(SPK))
+    measure("X3DH_FORWARD", {
+        "target": "bob",
+        "IPK": IPK,
+        "EPK": EPK,
+        "SPK": SPK,
+        "iv": iv,
+        "cipher": cipher,
+        "tag": tag,
+        "sender": "alice"
+    }, X3DH_FORWARD)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Measures how long the server takes to start with 1k, 10k and 100k registered users.
+Every fixture is created in the old format (db/database.json and db/peppers.csv), so the first start includes
+the migration to the SQLite database and the encrypted peppers. The second start is a normal restart.
+Run with `python -m project.benchmark.startup` from the root directory of the project.
+"""
+import os
+import sys
+import tempfile
+import time
+
+from project.server.server import Server
+from project.util import crypto_utils, x3dh_utils
+from project.util.database import Database
+
+USER_COUNTS = [1_000, 10_000, 100_000]
+
+
+def create_fixture(directory: str, users: int):
+    # Generating keys is slow, so all users share the same key bundle
+    keys = x3dh_utils.generate_initial_x3dh_keys()
+    key_bundle = {"IPK": keys["IPK"], "SPK": keys["SPK"], "OPKs": keys["OPKs"], "sigma": keys["sigma"]}
+    salt, pepper = os.urandom(32), os.urandom(32)
+
+    database = Database(os.path.join(directory, "db", "database.json"))
+    peppers = Database(os.path.join(directory, "db", "peppers.csv"), os.path.join(directory, "db", "server-key-peppers.txt"), True)
+    for i in range(users):
+        username = f"user{i}"
+        database.insert(username, {
+            "salt": salt,
+            "salted_password": crypto_utils.salt_password("password", salt, pepper),
+            "keys": key_bundle,
+            "registered": True,
+            "logged_in": False
+        }, save=False)
+        peppers.insert(username, pepper, save=False)
+    database.save()
+    peppers.save()
+
+
+def start_server() -> float:
+    start = time.perf_counter()
+    server = Server()
+    elapsed = time.perf_counter() - start
+    server.storage.close()
+    server.database.close()
+    server.peppers.close()
+    return elapsed
+
+
+def main():
+    counts = [int(count) for count in sys.argv[1:]] or USER_COUNTS
+    root = os.getcwd()
+    print(f"{'users':>8} {'first start (migration)':>24} {'restart':>10}")
+    for users in counts:
+        with tempfile.TemporaryDirectory() as directory:
+            create_fixture(directory, users)
+            os.chdir(directory)
+            try:
+                first = start_server()
+                restart = start_server()
+            finally:
+                os.chdir(root)
+        print(f"{users:>8} {first * 1000:>21.1f} ms {restart * 1000:>7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
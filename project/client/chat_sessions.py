@@ -0,0 +1,171 @@
+import atexit
+import threading
+import traceback
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from project.util import crypto_utils
+from project.util.database import Database, DURABILITY_ALWAYS, DURABILITY_PERIODIC, atomic_write
+from project.util.ratchet import DoubleRatchetState
+from project.util.utils import debug
+
+# Older versions stored all chats in one entry of the database, which had to be decrypted and encrypted as a whole
+LEGACY_KEY = "chats"
+
+
+class ChatSessions:
+    """
+    Keeps the chat sessions (ratchet states) of the user. Every session is stored encrypted in its own file, which is
+    only read when the chat is used, so opening the client and its memory depend on the active chats instead of all
+    contacts. The most recently used sessions are kept in memory.
+    Changed sessions are written in batches by a background thread, like the entries of a Database with the same
+    durability policy. Evicted sessions stay in memory until their changes are written.
+    """
+
+    def __init__(self, directory: str, key: bytes, capacity: int = 1024, durability: str = DURABILITY_ALWAYS,
+                 flush_interval: float = 1.0, flush_after: int = 100):
+        """
+        :param directory: The directory of the session files
+        :param key: The key the sessions are encrypted with
+        :param capacity: The number of sessions which are kept in memory
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.key: bytes = key
+        self.capacity: int = capacity
+        self.sessions: OrderedDict[str, DoubleRatchetState] = OrderedDict()
+        self.lock = threading.RLock()
+
+        self.durability: str = durability
+        self.flush_interval: float = flush_interval
+        self.flush_after: int = flush_after
+        self.pending: dict[str, DoubleRatchetState] = {}  # Sessions which were saved but not written yet
+        self.pending_saves = 0
+        self.flush_requested = threading.Event()
+        self.flusher: Optional[threading.Thread] = None
+        self.closed = False
+
+    def path(self, peer: str) -> Path:
+        return self.directory / f"{peer.encode().hex()}.drs"
+
+    @staticmethod
+    def associated_data(peer: str) -> bytes:
+        return f"chats/{peer}".encode()
+
+    def migrate(self, database: Database):
+        """Moves the chats of the single database entry used by older versions into their own files."""
+        chats = database.get(LEGACY_KEY)
+        if chats is None:
+            return
+        for peer, drs in chats.items():
+            self.write(peer, drs, True)
+        database.delete(LEGACY_KEY)
+        debug(f"Moved {len(chats)} chats into their own files.")
+
+    def load(self, peer: str) -> Optional[DoubleRatchetState]:
+        path = self.path(peer)
+        if not path.exists():
+            return None
+        encrypted = path.read_bytes()
+        iv, tag, cipher = encrypted[:12], encrypted[12:28], encrypted[28:]
+        return DoubleRatchetState.from_bytes(crypto_utils.aes_gcm_decrypt(self.key, iv, cipher, self.associated_data(peer), tag))
+
+    def write(self, peer: str, drs: DoubleRatchetState, sync: bool):
+        iv, cipher, tag = crypto_utils.aes_gcm_encrypt(self.key, drs.to_bytes(), self.associated_data(peer))
+        atomic_write(str(self.path(peer)), iv + tag + cipher, sync)
+
+    def get(self, peer: str) -> Optional[DoubleRatchetState]:
+        """Returns the session with the user, reading it from its file if it isn't in memory."""
+        with self.lock:
+            if peer in self.sessions:
+                self.sessions.move_to_end(peer)
+                return self.sessions[peer]
+
+            drs = self.pending[peer] if peer in self.pending else self.load(peer)
+            if drs is not None:
+                self.sessions[peer] = drs
+                self.evict()
+            return drs
+
+    def put(self, peer: str, drs: DoubleRatchetState):
+        """Adds or changes the session with the user and saves it."""
+        with self.lock:
+            self.sessions[peer] = drs
+            self.sessions.move_to_end(peer)
+            self.evict()
+            if self.durability == DURABILITY_ALWAYS:
+                self.write(peer, drs, True)
+                return
+
+            self.pending[peer] = drs
+            self.pending_saves += 1
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.run_flusher, daemon=True, name="chat-flusher")
+                self.flusher.start()
+                atexit.register(self.close)
+            if self.pending_saves >= self.flush_after:
+                self.flush_requested.set()
+
+    def save(self, peer: str, drs: DoubleRatchetState):
+        """Saves the session after it was used to encrypt or decrypt messages."""
+        self.put(peer, drs)
+
+    def flush(self, sync: Optional[bool] = None):
+        """
+        Writes all pending saves as one batch.
+        :param sync: Whether to wait until the sessions are on disk, by default depending on the durability policy
+        """
+        with self.lock:
+            pending, self.pending, self.pending_saves = self.pending, {}, 0
+            sync = self.durability == DURABILITY_PERIODIC if sync is None else sync
+            for peer, drs in list(pending.items()):
+                try:
+                    self.write(peer, drs, sync)
+                except Exception:
+                    # Keep the sessions which weren't written so the next flush writes them again
+                    self.pending.update({peer: drs for peer, drs in pending.items() if peer not in self.pending})
+                    raise
+                del pending[peer]
+
+    def run_flusher(self):
+        while not self.closed:
+            self.flush_requested.wait(self.flush_interval)
+            self.flush_requested.clear()
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+                debug(f"Failed to write the chats in {self.directory}. Trying again with the next batch.")
+
+    def remove(self, peer: str):
+        with self.lock:
+            self.sessions.pop(peer, None)
+            self.pending.pop(peer, None)
+            self.path(peer).unlink(missing_ok=True)
+
+    def clear(self):
+        """Deletes all sessions, e.g. because the account was deleted."""
+        with self.lock:
+            self.sessions.clear()
+            self.pending.clear()
+            for path in self.directory.glob("*.drs"):
+                path.unlink(missing_ok=True)
+
+    def evict(self):
+        while len(self.sessions) > self.capacity:
+            self.sessions.popitem(last=False)
+
+    def close(self):
+        """Writes all pending saves and syncs them to disk."""
+        if self.closed:
+            return
+        self.closed = True
+        self.flush_requested.set()
+        if self.flusher:
+            self.flusher.join()
+        self.flush(True)
+
+    def __contains__(self, peer: str) -> bool:
+        with self.lock:
+            return peer in self.sessions or peer in self.pending or self.path(peer).exists()
@@ -1,3 +1,5 @@
+import os
+import queue
 import select
 import socket
 import ssl
@@ -9,10 +11,13 @@ from typing import Optional
 from ecdsa import SigningKey, VerifyingKey
 
 from project.client.handler import login_handler, message_handler, x3dh_handler, reset_handler
-from project.util import x3dh_utils
-from project.util.database import Database
+from project.client.chat_sessions import ChatSessions
+from project.client.prekey_factory import PrekeyFactory
+from project.util import compression, x3dh_utils
+from project.util.database import Database, LogDatabase, EncryptedDatabase, DURABILITY_PERIODIC, migrate_database
+from project.util.framing import FramedSocket
 from project.util.message import Message, MESSAGE, REGISTER, LOGIN, IDENTITY, ANSWER_SALT, STATUS, X3DH_BUNDLE_REQUEST, X3DH_FORWARD, X3DH_REQUEST_KEYS, \
-    is_valid_message, RESET
+    is_valid_message, RESET, OFFLINE_ACK
 from project.util.serializer.serializer import encode_message
 from project.util.utils import debug
 
@@ -20,15 +25,25 @@ enable_debug = True
 
 
 class Client:
-    def __init__(self, host="localhost", port=25567):
+    def __init__(self, host="localhost", port=25567, chat_cache_size: int = 1024):
+        """
+        :param chat_cache_size: The number of chat sessions which are kept in memory, see ChatSessions
+        """
         self.host: str = host
         self.port: int = port
         self.client_socket: Optional[ssl.SSLSocket] = None
+        self.connection: Optional[FramedSocket] = None
         self.receive_thread: Optional[threading.Thread] = None
         self.send_thread: Optional[threading.Thread] = None
+        # Chat messages typed by the user, sent by the outbox thread so bursts can be sent together
+        self.outbox: queue.Queue[Optional[tuple[str, str]]] = queue.Queue()
+        self.outbox_thread: Optional[threading.Thread] = None
 
         self.username: Optional[str] = None
         self.database: Optional[Database] = None
+        self.chat_cache_size: int = chat_cache_size
+        self.chats: Optional[ChatSessions] = None
+        self.prekey_factory = PrekeyFactory()  # Generates one-time prekeys in the background
 
         self.handlers: dict[str, any] = {
             REGISTER: login_handler.handle_register,
@@ -39,7 +54,8 @@ class Client:
             X3DH_BUNDLE_REQUEST: x3dh_handler.handle_x3dh_bundle_answer,
             X3DH_FORWARD: x3dh_handler.handle_x3dh_forward,
             X3DH_REQUEST_KEYS: x3dh_handler.handle_x3dh_key_request,
-            RESET: reset_handler.handle_reset
+            RESET: reset_handler.handle_reset,
+            OFFLINE_ACK: message_handler.handle_offline_ack
         }
 
         # Add event to signal when to stop threads
@@ -57,6 +73,7 @@ class Client:
             self.client_socket = context.wrap_socket(raw_socket, server_hostname=self.host)
 
             self.client_socket.connect((self.host, self.port))
+            self.connection = FramedSocket(self.client_socket)
             debug(f"Connected to server {self.host}:{self.port}.")
         except Exception as e:
             traceback.print_exc()
@@ -65,7 +82,7 @@ class Client:
 
     def send(self, receiver: str, content: dict[str, any], type: str = MESSAGE):
         try:
-            self.client_socket.send(
+            self.connection.send_frame(
                 Message(message=encode_message(content), sender=self.username, receiver=receiver, type=type).to_bytes())
         except Exception:
             traceback.print_exc()
@@ -77,18 +94,11 @@ class Client:
                 # Use select to check if data is available to read on the socket
                 readable, _, _ = select.select([self.client_socket], [], [], 1.0)  # 1 second timeout
                 if readable:
-                    message_bytes = self.client_socket.recv(8096)
-                    if not message_bytes:
+                    frames = self.connection.recv_frames()
+                    if frames is None:
                         debug("Connection closed.")
                         break
-                    message = Message.from_bytes(message_bytes)
-                    if is_valid_message(message):
-                        type = message.type
-                        handler = self.handlers.get(type, self.handle_unknown)
-                        if not handler(self, message):
-                            break
-                    else:
-                        debug("Server sent invalid message! Closing connection.")
+                    if not self.handle_frames(frames):
                         break
         except (ConnectionResetError, OSError):
             debug("Connection closed.")
@@ -99,7 +109,68 @@ class Client:
             if self.client_socket:
                 self.client_socket.close()
 
+    def handle_frames(self, frames: list[bytes]) -> bool:
+        """
+        Handles all messages received in one read.
+        :return: Whether the connection should be kept open
+        """
+        for message_bytes in frames:
+            message = Message.from_bytes(message_bytes)
+            if is_valid_message(message):
+                type = message.type
+                handler = self.handlers.get(type, self.handle_unknown)
+                if message.sender == "server":
+                    if not handler(self, message):
+                        return False
+                    continue
+                # Other users can send anything, a broken message is dropped instead of closing the connection.
+                # Otherwise it would be delivered again with every login, as it is never acknowledged.
+                try:
+                    if not handler(self, message):
+                        return False
+                except Exception:
+                    traceback.print_exc()
+                    debug(f"Failed to handle a message from {message.sender}. Dropping it.")
+            elif is_valid_message(message, decode_content=False) and message.sender != "server":
+                debug(f"Received a message from {message.sender} which couldn't be decoded. Dropping it.")
+            else:
+                debug("Server sent invalid message! Closing connection.")
+                return False
+        return True
+
+    def send_outbox(self):
+        """
+        Sends the chat messages queued by send_messages. All messages which were queued while the previous ones
+        were sent (e.g. pasted lines) are sent as one burst per receiver, see message_handler.send_messages.
+        """
+        while True:
+            burst = [self.outbox.get()]
+            while burst[-1] is not None:
+                try:
+                    burst.append(self.outbox.get_nowait())
+                except queue.Empty:
+                    break
+
+            receivers: dict[str, list[str]] = {}
+            for item in burst:
+                if item:
+                    receivers.setdefault(item[0], []).append(item[1])
+            for receiver, texts in receivers.items():
+                try:
+                    if not message_handler.send_messages(self, receiver, texts):
+                        debug("Failed to send message.")
+                except Exception:
+                    traceback.print_exc()
+                    debug("Failed to send message.")
+
+            for _ in burst:
+                self.outbox.task_done()
+            if burst[-1] is None:
+                return
+
     def send_messages(self):
+        self.outbox_thread = threading.Thread(target=self.send_outbox, daemon=True, name="outbox")
+        self.outbox_thread.start()
         try:
             debug("You can now send messages to the server.")
             debug("Type 'exit' to close the connection.")
@@ -114,6 +185,7 @@ class Client:
                     debug("Error reading input. Maybe an unsupported encoding was used?")
                     continue
                 if msg.lower() == "exit":
+                    self.outbox.join()
                     debug("Closing connection.")
                     self.stop_event.set()  # Signal the receive thread to stop
                     self.client_socket.close()
@@ -127,11 +199,15 @@ class Client:
                         debug("You cannot send messages to yourself.")
                         continue
 
+                    if type in ["init", "reset"]:
+                        # Queued messages have to be sent before the chat changes
+                        self.outbox.join()
+
                     if type == "init":
                         if receiver == "server":
                             debug("You cannot initiate a key exchange with the server.")
                             continue
-                        if (self.database.get("chats") and self.database.get("chats").get(receiver)) or (self.database.get("shared_secrets") and self.database.get("shared_secrets").get(receiver)):
+                        if receiver in self.chats or (self.database.get("shared_secrets") and self.database.get("shared_secrets").get(receiver)):
                             debug(f"Already have shared secret with {receiver}. Use 'reset {receiver}' to reset or 'msg {receiver} <message>' to send a message.")
                             continue
                         debug(f"Requesting key bundle for {receiver}...")
@@ -147,9 +223,7 @@ class Client:
                         if receiver == "server":
                             debug("You cannot send a message to the server.")
                             continue
-                        text = " ".join(split[2:])
-                        if not message_handler.send_message(self, receiver, text):
-                            debug("Failed to send message.")
+                        self.outbox.put((receiver, " ".join(split[2:])))
                     else:
                         debug("Unknown command. Please use 'init', 'msg' or 'reset'.")
 
@@ -161,6 +235,8 @@ class Client:
             debug("Error sending messages.")
             debug("Closing connection.")
         finally:
+            self.outbox.put(None)
+            self.outbox_thread.join()
             self.stop_event.set()
             self.client_socket.close()
 
@@ -173,28 +249,47 @@ class Client:
             return False
         debug(f"Connected to server {self.host}:{self.port} as {self.username}.")
 
-        self.database = Database(f"db/{self.username}/database.json", f"db/{self.username}/key.txt")
+        self.database = self.open_database()
 
         self.receive_thread = threading.Thread(target=self.receive_message, daemon=True)
         self.receive_thread.start()
 
         time.sleep(0.1)
-        self.send("server", {"username": self.username}, IDENTITY)  # Send the identity message to the server
+        # Send the identity message to the server
+        self.send("server", {"username": self.username, "compression": compression.SUPPORTED, "offline_acks": True}, IDENTITY)
 
         # Wait for the threads to finish
         if self.receive_thread:
             self.receive_thread.join()
         if self.send_thread:
             self.send_thread.join()
+        self.chats.close()
+        self.database.close()
+        self.prekey_factory.close()
 
     def handle_unknown(self, message: Message):
         debug(f"{message.sender} sent message of unknown type '{message.type}'. Closing connection to be safe.")
         return False
 
+    def open_database(self) -> EncryptedDatabase:
+        """
+        Opens the encrypted database of the user and moves the entries of an unencrypted database from older versions into it.
+        Ratchet steps are saved after every message, so they are written in batches.
+        Also opens the chat sessions, which are stored in their own files next to the database.
+        """
+        database = EncryptedDatabase(f"db/{self.username}/database.encrypted.json", f"db/{self.username}/key.txt", durability=DURABILITY_PERIODIC)
+        old_path = f"db/{self.username}/database.json"
+        if os.path.exists(old_path) or os.path.exists(old_path + ".log"):
+            migrate_database(LogDatabase(old_path), database)
+            debug(f"Moved {old_path} into the encrypted database.")
+        self.chats = ChatSessions(f"db/{self.username}/chats", database.encryption_key, self.chat_cache_size, DURABILITY_PERIODIC)
+        self.chats.migrate(database)
+        return database
+
     def load_or_gen_keys(self) -> dict[str, SigningKey, VerifyingKey]:
         keys = self.database.get("keys")
         if not keys:
-            keys = x3dh_utils.generate_initial_x3dh_keys()
+            keys = x3dh_utils.generate_initial_x3dh_keys(self.prekey_factory.take(7))
             self.database.insert("keys", keys)
         return keys
 
@@ -20,7 +20,11 @@ def handle_status(client, message: Message) -> bool:
     if content.get("status") == ERROR:
         debug(f"Received error from server: {content.get('error')}")
         return False
-    elif content.get("status") == NOT_REGISTERED:
+
+    # Use the compression mode chosen by the server for the frames we send
+    client.connection.enable_compression(content.get("compression"))
+
+    if content.get("status") == NOT_REGISTERED:
         debug("User not registered.")
         try:
             password = input("Enter your new password: ")
@@ -1,29 +1,35 @@
 from ecdsa import VerifyingKey
 
-from project.util.message import Message, ERROR
+from project.util.message import Message, ERROR, OFFLINE_ACK
 from project.util.ratchet import DoubleRatchetState
 from project.util.utils import debug
 
 
 def send_message(client, receiver: str, plaintext: str) -> bool:
-    if not plaintext or len(plaintext.strip()) == 0:
+    return send_messages(client, receiver, [plaintext])
+
+
+def send_messages(client, receiver: str, plaintexts: list[str]) -> bool:
+    """
+    Sends a burst of messages to the same user with one frame and saves the chat once.
+    A single message is sent on its own, several messages are sent as list in the content field "messages".
+    """
+    plaintexts = [plaintext for plaintext in plaintexts if plaintext and len(plaintext.strip()) > 0]
+    if not plaintexts:
         debug("Empty messages aren't allowed.")
         return True
 
-    if not client.database.has("chats"):
-        client.database.insert("chats", {})
-
     if not init_chat_sender(client, receiver):
         return False
 
-    if not client.database.has("chats") or not client.database.get("chats").get(receiver):
+    drs = client.chats.get(receiver)
+    if not drs:
         debug(f"No shared secret found for {receiver}. Initiate a chat using 'init {receiver}'.")
         return False
 
-    drs = client.database.get("chats").get(receiver)
-    message = drs.encrypt(plaintext.encode())
-    client.send(receiver, message)
-    client.database.save()
+    messages = drs.encrypt_many([plaintext.encode() for plaintext in plaintexts])
+    client.send(receiver, messages[0] if len(messages) == 1 else {"messages": messages})
+    client.chats.save(receiver, drs)
     return True
 
 
@@ -39,26 +45,36 @@ def handle_message(client, message: Message) -> bool:
     else:
         content = message.dict()
         sender = message.sender
-        database = client.database
 
         init_chat_receiver(client, sender)
 
-        drs = database.get("chats").get(sender)
+        drs = client.chats.get(sender)
+        # Bursts of messages are sent as one message with a list of messages
+        messages = content.get("messages") if isinstance(content.get("messages"), list) else [content]
         try:
-            plaintext = drs.decrypt(content)
-            debug(f"{sender}: {plaintext.decode()}")
+            plaintexts = drs.decrypt_many(messages)
         except Exception as e:
             debug(f"Failed to decrypt message from {sender}.")
             return True
-        client.database.save()
+        client.chats.save(sender, drs)
+        for plaintext in plaintexts:
+            if plaintext:
+                debug(f"{sender}: {plaintext.decode(errors="replace")}")
 
         return True
 
-def init_chat_sender(client, receiver: str) -> bool:
-    if not client.database.has("chats"):
-        client.database.insert("chats", {})
+def handle_offline_ack(client, message: Message) -> bool:
+    """Called after a page of offline messages. The messages before it were handled, so the server can delete them."""
+    # The server deletes the page once it is acknowledged, so the changes made while handling it have to be on disk
+    client.chats.flush(True)
+    client.database.flush()
+    if client.database.unsynced:
+        client.database.sync()
+    client.send("server", {"last_id": message.dict().get("last_id")}, OFFLINE_ACK)
+    return True
 
-    if not client.database.get("chats").get(receiver):
+def init_chat_sender(client, receiver: str) -> bool:
+    if receiver not in client.chats:
 
         if not client.database.has("shared_secrets") or not client.database.get("shared_secrets").get(receiver):
             debug(f"No shared secret found for {receiver}. Initiate a chat using 'init {receiver}'.")
@@ -71,28 +87,25 @@ def init_chat_sender(client, receiver: str) -> bool:
         root_key = client.database.get("shared_secrets").get(receiver)
         # Remove the shared secret from the database
         client.database.get("shared_secrets").pop(receiver)
-        client.database.save()
+        client.database.save("shared_secrets")
 
         drs = DoubleRatchetState(root_key, None, None, SPK_B, initialized_by_me=True)
-        client.database.update("chats", {receiver: drs})
+        client.chats.put(receiver, drs)
 
     return True
 
 def init_chat_receiver(client, sender: str) -> bool:
-    if not client.database.has("chats"):
-        client.database.insert("chats", {})
-
     if not client.database.has("shared_secrets") or not client.database.get("shared_secrets").get(sender):
         return False
 
     root_key = client.database.get("shared_secrets").get(sender)
     # Remove the shared secret from the database
     client.database.get("shared_secrets").pop(sender)
-    client.database.save()
+    client.database.save("shared_secrets")
 
-    if not client.database.get("chats").get(sender):
+    if sender not in client.chats:
         sk, SPK = client.database.get("keys").get("sk"), client.database.get("keys").get("SPK")
         drs = DoubleRatchetState(root_key, sk, SPK, initialized_by_me=False)
-        client.database.update("chats", {sender: drs})
+        client.chats.put(sender, drs)
 
     return True
\ No newline at end of file
@@ -20,6 +20,7 @@ def reset(client, receiver: str):
         clear_from_db(client, receiver)
     else:
         client.database.clear()
+        client.chats.clear()
 
 
 def clear_from_db(client, receiver: str):
@@ -27,8 +28,7 @@ def clear_from_db(client, receiver: str):
         client.database.get("shared_secrets").pop(receiver)
     if client.database.get("key_bundles") and client.database.get("key_bundles").get(receiver):
         client.database.get("key_bundles").pop(receiver)
-    if client.database.get("chats") and client.database.get("chats").get(receiver):
-        client.database.get("chats").pop(receiver)
-    client.database.save()
+    client.chats.remove(receiver)
+    client.database.save("shared_secrets", "key_bundles")
     debug(f"Deleted shared secret, chat and key bundle with {receiver} from the database.")
     return True
@@ -1,4 +1,4 @@
-import traceback
+from hashlib import sha256
 
 from ecdsa import SigningKey, VerifyingKey
 
@@ -33,8 +33,16 @@ def handle_x3dh_bundle_answer(client, message: Message) -> bool:
     SPK_B: VerifyingKey = key_bundle_b.get("SPK")
     OPK_B: VerifyingKey = key_bundle_b.get("OPK")
 
+    if not all(crypto_utils.is_public_key(key) for key in [IPK_B, SPK_B, OPK_B]) or not isinstance(sigma_B, bytes):
+        debug(f"Received invalid key bundle for {content.get("owner")} from server.")
+        return True
+
+    # The IPK and SPK of a peer are used in every handshake with them. Only the original keys are stored,
+    # precomputed tables are kept by the crypto provider
+    precomputed_IPK_B = crypto_utils.precompute(IPK_B)
+    precomputed_SPK_B = crypto_utils.precompute(SPK_B)
 
-    if not crypto_utils.ecdsa_verify(sigma_B, SPK_B.to_pem(), IPK_B):
+    if not verify_key_bundle(client, content.get("owner"), precomputed_IPK_B, SPK_B, sigma_B):
         debug("Invalid signature for SPK_B. Aborting X3DH.")
     else:
         key_bundles = client.database.get("key_bundles")
@@ -43,19 +51,21 @@ def handle_x3dh_bundle_answer(client, message: Message) -> bool:
             client.database.update("key_bundles", key_bundles)
         else:
             key_bundles.update({content.get("owner"): {"SPK": SPK_B}})
+            client.database.save("key_bundles")
         debug("Computing shared secret...")
-        ek_A, EPK_A = crypto_utils.generate_signature_key_pair()
-        shared_secret = x3dh_utils.x3dh_key(ik_A, ek_A, IPK_B, SPK_B, OPK_B)
+        ek_A, EPK_A = client.prekey_factory.take(1)[0]
+        shared_secret = x3dh_utils.x3dh_key(ik_A, ek_A, precomputed_IPK_B, precomputed_SPK_B, OPK_B)
         client.database.update("shared_secrets", {content.get("owner"): shared_secret})
         debug("Sending reaction to server...")
         debug(f"Shared secret computed and saved for {content.get('owner')}.")
-        iv, cipher, tag = crypto_utils.aes_gcm_encrypt(shared_secret, client.username.encode(), IPK_A.to_pem() + IPK_B.to_pem())
+        iv, cipher, tag = crypto_utils.aes_gcm_encrypt(shared_secret, client.username.encode(), crypto_utils.public_key_pem(IPK_A) + crypto_utils.public_key_pem(IPK_B))
 
         client.send("server", {
             "target": content.get("owner"),
             "IPK": IPK_A,
             "EPK": EPK_A,
             "SPK": SPK_A,
+            "OPK": OPK_B,  # Lets the receiver pick the matching one-time prekey
             "iv": iv,
             "cipher": cipher,
             "tag": tag
@@ -64,6 +74,23 @@ def handle_x3dh_bundle_answer(client, message: Message) -> bool:
     return True
 
 
+def verify_key_bundle(client, owner: str, IPK: VerifyingKey, SPK: VerifyingKey, sigma: bytes) -> bool:
+    """
+    Verifies the signature of the SPK in a key bundle.
+    The last verified bundle of every user is stored as hash of the IPK, SPK and signature, so the signature
+    is only checked again once the user changes their SPK or IPK.
+    """
+    digest = sha256(crypto_utils.encode_public_key(IPK) + crypto_utils.encode_public_key(SPK) + sigma).digest()
+    verified_bundles = client.database.get("verified_bundles")
+    if verified_bundles and verified_bundles.get(owner) == digest:
+        return True
+
+    if not crypto_utils.ecdsa_verify(sigma, crypto_utils.public_key_pem(SPK), IPK):
+        return False
+    client.database.update("verified_bundles", {owner: digest})
+    return True
+
+
 def handle_x3dh_forward(client, message: Message) -> bool:
     content = message.dict()
     debug(f"Received a forwarded x3dh message for {content.get('target')} from server.")
@@ -76,16 +103,15 @@ def handle_x3dh_forward(client, message: Message) -> bool:
         debug(f"Received x3dh message with invalid ciphertext {content.get('sender')}.")
         return True
 
-    if not all(isinstance(content.get(x), VerifyingKey) for x in ["IPK", "SPK", "EPK"]):
+    if not all(crypto_utils.is_public_key(content.get(x)) for x in ["IPK", "SPK", "EPK"]):
         debug(f"Received x3dh message with invalid keys from {content.get('sender')}.")
         return True
 
     keys = client.load_or_gen_keys()
     ik_B: SigningKey = keys["ik"]
     sk_B: SigningKey = keys["sk"]
-    ok_B: SigningKey = keys["oks"][0]
     IPK_B: VerifyingKey = keys["IPK"]
-    IPK_A: VerifyingKey = content.get("IPK")
+    IPK_A: VerifyingKey = crypto_utils.precompute(content.get("IPK"))
     SPK_A: VerifyingKey = content.get("SPK")
     EPK_A: VerifyingKey = content.get("EPK")
 
@@ -93,33 +119,51 @@ def handle_x3dh_forward(client, message: Message) -> bool:
     cipher: bytes = content.get("cipher")
     tag: bytes = content.get("tag")
     sender: str = content.get("sender")
-    keys.get("oks").pop(0)
-    keys.get("OPKs").pop(0)
-    client.database.save()
-    if len(keys.get("oks")) == 0:
-        debug("No more one time prekeys left. Sending new ones to server.")
-        OPKs = add_new_pre_keys(client)
-        client.send("server", {"OPKs": OPKs}, X3DH_REQUEST_KEYS)
-
-    shared_secret = x3dh_utils.x3dh_key_reaction(IPK_A, EPK_A, ik_B, sk_B, ok_B)
-    try:
-        decrypted = crypto_utils.aes_gcm_decrypt(shared_secret, iv, cipher, IPK_A.to_pem() + IPK_B.to_pem(), tag)
-        if decrypted == sender.encode():
-            debug(f"Succesfully computed shared secret with {sender}.")
-            client.database.update("shared_secrets", {sender: shared_secret})
-            client.database.update("key_bundles", {sender: {"SPK": SPK_A}})
-        else:
-            debug(f"Decryption from {sender} is incorrect. Generating shared secret failed.")
+    associated_data = crypto_utils.public_key_pem(IPK_A) + crypto_utils.public_key_pem(IPK_B)
 
+    # Offline messages can be delivered again after a reconnect, so a forward may already have been handled.
+    # Its one-time prekey is only removed once the shared secret was verified, a replayed forward finds no key.
+    candidates = one_time_pre_key_candidates(keys, content.get("OPK"))
+    if not candidates:
+        debug(f"Received x3dh message from {sender} for a one-time prekey which was already used. Ignoring it.")
         return True
-    except Exception as e:
-        debug(f"Failed to decrypt message from {sender}. Generating shared secret failed.")
-        traceback.print_exc()
+
+    for index in candidates:
+        shared_secret = x3dh_utils.x3dh_key_reaction(IPK_A, EPK_A, ik_B, sk_B, keys["oks"][index])
+        try:
+            decrypted = crypto_utils.aes_gcm_decrypt(shared_secret, iv, cipher, associated_data, tag)
+        except Exception:
+            continue
+        if decrypted != sender.encode():
+            continue
+
+        # The server requests new one-time prekeys before they run out
+        keys["oks"].pop(index)
+        keys["OPKs"].pop(index)
+        client.database.save("keys")
+        debug(f"Succesfully computed shared secret with {sender}.")
+        client.database.update("shared_secrets", {sender: shared_secret})
+        client.database.update("key_bundles", {sender: {"SPK": SPK_A}})
         return True
 
+    debug(f"Failed to decrypt x3dh message from {sender}. Generating shared secret failed.")
+    return True
+
+
+def one_time_pre_key_candidates(keys: dict, OPK: VerifyingKey) -> list[int]:
+    """
+    Returns the indices of the one-time prekeys which may have been used for an x3dh message.
+    Clients which don't send the used OPK claimed the oldest key which the server still had, which may not be the
+    first key of the client if a forward was lost, so all keys are candidates.
+    """
+    if not crypto_utils.is_public_key(OPK):
+        return list(range(len(keys["oks"])))
+    encoded = crypto_utils.encode_public_key(OPK)
+    return [index for index, key in enumerate(keys["OPKs"]) if crypto_utils.encode_public_key(key) == encoded]
+
 
 def handle_x3dh_key_request(client, message: Message) -> bool:
-    """Called when the server doesn't have one time prekeys for the user."""
+    """Called when the server is running low on one time prekeys for the user."""
 
     if message.dict().get("status") == ERROR:
         debug("Failed to request key bundle from server.")
@@ -134,10 +178,10 @@ def handle_x3dh_key_request(client, message: Message) -> bool:
 
 
 def add_new_pre_keys(client) -> list[VerifyingKey]:
-    keys = crypto_utils.generate_one_time_pre_keys(5)
+    keys = client.prekey_factory.take(client.prekey_factory.batch_size)
     oks = [ok for ok, _ in keys]
     OPKs = [OPK for _, OPK in keys]
     client.load_or_gen_keys()["OPKs"].extend(OPKs)
     client.load_or_gen_keys()["oks"].extend(oks)
-    client.database.save()
+    client.database.save("keys")
     return OPKs
\ No newline at end of file
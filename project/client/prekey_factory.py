@@ -0,0 +1,89 @@
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from ecdsa import SigningKey, VerifyingKey
+
+from project.util import crypto_utils
+from project.util.utils import debug
+
+
+def generate_key_pairs(provider: str, amount: int) -> list[tuple[SigningKey, VerifyingKey]]:
+    """Generates key pairs in a worker process, which has to use the same crypto provider as the client."""
+    if crypto_utils.provider.name != provider:
+        crypto_utils.set_provider(provider)
+    return crypto_utils.generate_one_time_pre_keys(amount)
+
+
+class PrekeyFactory:
+    """
+    Keeps a reserve of key pairs which are generated in the background by a process pool.
+    Generating keys with ecdsa is slow, so taking keys from the reserve keeps the receive thread responsive.
+    If the reserve is empty, the missing keys are generated right away.
+    Crypto providers which generate keys quickly (and whose keys can't be pickled) don't use a process pool.
+    """
+
+    def __init__(self, batch_size: int = 5, reserve_batches: int = 3, workers: int = 1):
+        """
+        :param batch_size: The number of key pairs generated by one task, also the number of one-time prekeys sent to the server at once
+        :param reserve_batches: The number of batches which are kept in reserve
+        :param workers: The number of processes generating keys
+        """
+        self.batch_size: int = batch_size
+        self.reserve_size: int = batch_size * reserve_batches
+        self.reserve: deque[tuple[SigningKey, VerifyingKey]] = deque()
+        self.pending: list[Future] = []
+        self.lock = threading.RLock()  # Callbacks of futures which are already done run while submitting them
+        self.executor: Optional[ProcessPoolExecutor] = None
+        if not crypto_utils.provider.fast_key_generation:
+            # Forking a process with running threads isn't safe, so the workers are started from scratch
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.refill()
+
+    def refill(self):
+        """Starts generating batches until the reserve and the batches being generated reach the reserve size."""
+        with self.lock:
+            if not self.executor:
+                return
+            while len(self.reserve) + len(self.pending) * self.batch_size < self.reserve_size:
+                try:
+                    future = self.executor.submit(generate_key_pairs, crypto_utils.provider.name, self.batch_size)
+                except BrokenProcessPool:
+                    # Keys are generated when they are taken from now on
+                    debug("The process pool generating key pairs stopped working.")
+                    self.executor = None
+                    return
+                self.pending.append(future)
+                future.add_done_callback(self.add_batch)
+
+    def add_batch(self, future: Future):
+        with self.lock:
+            self.pending.remove(future)
+            if future.cancelled():
+                return
+            if future.exception():
+                debug(f"Failed to generate key pairs in the background: {future.exception()}")
+                return
+            self.reserve.extend(future.result())
+
+    def take(self, amount: int) -> list[tuple[SigningKey, VerifyingKey]]:
+        """
+        Takes key pairs from the reserve and starts generating new ones in the background.
+        :param amount: The number of key pairs
+        :return: A list of (private key, public key) tuples
+        """
+        with self.lock:
+            key_pairs = [self.reserve.popleft() for _ in range(min(amount, len(self.reserve)))]
+        if len(key_pairs) < amount:
+            key_pairs += crypto_utils.generate_one_time_pre_keys(amount - len(key_pairs))
+        self.refill()
+        return key_pairs
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
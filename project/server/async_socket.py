@@ -0,0 +1,58 @@
+import asyncio
+import threading
+
+
+class AsyncClientSocket:
+    """
+    Socket-like wrapper around an asyncio StreamWriter.
+    Handlers only ever call send/sendall, getpeername and close on a client socket, so wrapping the writer
+    lets the same handlers run unchanged in the threaded and the asyncio server mode.
+    Like sendall of a blocking socket, sendall called by a handler thread waits until the writer has room again, so
+    a client which doesn't read slows down the handlers sending to it instead of filling the memory of the server.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, write_timeout: float = 30):
+        """
+        :param write_timeout: The number of seconds sendall waits for the client to read
+        """
+        self.writer = writer
+        self.write_timeout: float = write_timeout
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+
+    def _call(self, function, *args):
+        # StreamWriter is not thread safe, calls from other threads have to be scheduled on the event loop
+        if threading.get_ident() == self.loop_thread:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def send(self, data: bytes) -> int:
+        self._call(self.writer.write, data)
+        return len(data)
+
+    def sendall(self, data: bytes) -> None:
+        if threading.get_ident() == self.loop_thread:
+            self.writer.write(data)
+            return
+        asyncio.run_coroutine_threadsafe(self.write(data), self.loop).result(self.write_timeout)
+
+    async def write(self, data: bytes):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def drain(self):
+        """Waits until the write buffer of the writer is below its limit. Returns right away on the event loop."""
+        if threading.get_ident() == self.loop_thread:
+            return
+        asyncio.run_coroutine_threadsafe(self.writer.drain(), self.loop).result(self.write_timeout)
+
+    def getpeername(self) -> tuple[str, int]:
+        return self.writer.get_extra_info("peername")
+
+    def close(self):
+        self._call(self.writer.close)
+
+    def abort(self):
+        """Closes the connection without writing the buffered data."""
+        self._call(self.writer.transport.abort)
@@ -1,19 +1,19 @@
-from ssl import SSLSocket
-
+from project.util import compression
+from project.util.framing import FramedSocket
 from project.util.message import IDENTITY, ERROR, STATUS, NOT_REGISTERED, REGISTERED, Message
 from project.util.utils import debug, check_username
 from project.util.message import is_valid_message
 
 
-def check_identity(server, client_socket: SSLSocket, addr: tuple[str, int]) -> bool:
+def check_identity(server, client_socket: FramedSocket, addr: tuple[str, int], received_bytes: bytes) -> bool:
     """
     Checks the initial message sent by the client.
     The initial message has to be of type 'identity' and contain a username.
     :param client_socket The user's socket
     :param addr: The user's address
+    :param received_bytes: The first bytes received from the user
     :return Whether the check was successful
     """
-    received_bytes = client_socket.recv(1024)
     debug("Received bytes.")
 
     if not received_bytes:
@@ -45,11 +45,18 @@ def check_identity(server, client_socket: SSLSocket, addr: tuple[str, int]) -> b
 
     server.connections[message.sender] = addr
     server.sockets[addr] = client_socket
+    if message.dict().get("offline_acks") is True:
+        server.delivery.acknowledging.add(username)
+
+    # Frames sent to the client are compressed if it supports it, starting after the status message
+    compression_mode = compression.negotiate(message.dict().get("compression"))
 
     if not server.is_registered(username):
         debug(f"{message.sender} ({addr}) sent a status request, User is currently not registered.")
-        server.send(message.sender, {"status": NOT_REGISTERED}, STATUS)
+        server.send(message.sender, {"status": NOT_REGISTERED, "compression": compression_mode}, STATUS)
     else:
         debug(f"{message.sender} ({addr}) sent a status request, User is registered.")
-        server.send(message.sender, {"status": REGISTERED}, STATUS)
+        server.send(message.sender, {"status": REGISTERED, "compression": compression_mode}, STATUS)
+
+    client_socket.enable_compression(compression_mode)
     return True
@@ -1,8 +1,6 @@
 import os
 from ssl import SSLSocket
 
-from ecdsa import VerifyingKey
-
 from project.util import crypto_utils
 from project.util.message import *
 from project.util.utils import debug
@@ -21,14 +19,13 @@ def handle_login(server, message: Message, client: SSLSocket, addr: tuple[str, i
             return
         debug("Checking password...")
         salted_password = content.get("salted_password")
-        if salted_password == server.database.get(message.sender).get("salted_password"):
+        if salted_password == server.storage.get_field(message.sender, "salted_password").result():
             debug(f"{message.sender}'s ({addr}) password is correct. User is now logged in.")
             server.send(message.sender, {"status": SUCCESS}, LOGIN)
-            if "offline_messages" in server.database.get(message.sender):
-                for offline_message in server.database.get(message.sender).get("offline_messages"):
-                    server.send_bytes(offline_message.to_bytes(), message.sender)
-                server.database.update(message.sender, {"offline_messages": []})
-            server.database.update(message.sender, {"logged_in": True})
+            # Offline messages are sent in the background, messages arriving until then are stored behind them
+            server.delivery.start(message.sender)
+            server.prekeys.reset_refill(message.sender)
+            server.sessions.add(message.sender)
         else:
             debug(f"{message.sender}'s ({addr}) password is incorrect!")
             server.add_login_attempt(message.sender)
@@ -52,18 +49,18 @@ def handle_register(server, message: Message, client: SSLSocket, addr: tuple[str
         debug(f"{message.sender} ({addr}) sent invalid key bundle.")
         server.send(message.sender, {"status": ERROR, "error": "Invalid key bundle."}, REGISTER)
 
-    if not all([isinstance(key_bundle.get("IPK"), VerifyingKey), isinstance(key_bundle.get("SPK"), VerifyingKey), isinstance(key_bundle.get("sigma"), bytes)]):
+    if not all([crypto_utils.is_public_key(key_bundle.get("IPK")), crypto_utils.is_public_key(key_bundle.get("SPK")), isinstance(key_bundle.get("sigma"), bytes)]):
         debug(f"{message.sender} ({addr}) sent invalid key bundle.")
         server.send(message.sender, {"status": ERROR, "error": "Invalid key bundle."}, REGISTER)
         return
 
-    if not all([isinstance(opk, VerifyingKey) for opk in key_bundle.get("OPKs")]):
+    if not all([crypto_utils.is_public_key(opk) for opk in key_bundle.get("OPKs")]):
         debug(f"{message.sender} ({addr}) sent invalid key bundle.")
         server.send(message.sender, {"status": ERROR, "error": "Invalid key bundle."}, REGISTER)
         return
 
-    user_known = server.database.has(message.sender)
-    salt_set = user_known and server.database.get(message.sender).get("salt")
+    user_known = server.storage.has_user(message.sender).result()
+    salt_set = user_known and server.storage.get_field(message.sender, "salt").result()
     pepper_set = user_known and server.peppers.get(message.sender)
 
     debug(f"{message.sender} ({addr}) is trying to register.")
@@ -71,7 +68,7 @@ def handle_register(server, message: Message, client: SSLSocket, addr: tuple[str
     salt = server.get_or_gen_salt(message.sender)
     if not salt_set:
         debug(f"Creating salt for {message.sender} ({addr}).")
-        server.database.update(message.sender, {"salt": salt})
+        server.storage.set_field(message.sender, "salt", salt)
 
     if not pepper_set:
         debug(f"Creating pepper for {message.sender} ({addr}).")
@@ -80,8 +77,8 @@ def handle_register(server, message: Message, client: SSLSocket, addr: tuple[str
 
     debug(f"Saving password for {message.sender} ({addr}). Sending salt to client.")
 
-    salted_password = crypto_utils.salt_password(password, server.database.get(message.sender).get("salt"), server.peppers.get(message.sender))
-    server.database.update(message.sender, {"salted_password": salted_password, "keys": key_bundle, "registered": True})
+    salted_password = crypto_utils.salt_password(password, server.storage.get_field(message.sender, "salt").result(), server.peppers.get(message.sender))
+    server.storage.register(message.sender, salted_password, key_bundle).result()
     server.send(message.sender, {"status": SUCCESS, "salt": salt, "pepper": server.peppers.get(message.sender)}, REGISTER)
 
 def handle_request_salt(server, message: Message, client: SSLSocket, addr: tuple[str, int]):
@@ -15,5 +15,20 @@ def handle_message(server, message: Message, client: SSLSocket, addr: tuple[str,
         server.add_offline_message(message.receiver, message)
         return
 
+    raw = message.raw if message.raw is not None else message.to_bytes()
+    if server.delivery.store_if_draining(message.receiver, raw):
+        debug(f"{message.sender} ({addr}) sent a message to {message.receiver}, who is still receiving offline messages. Saving it behind them.")
+        return
+
     debug(f"{message.sender} ({addr}) sent a message to {message.receiver}.")
-    server.send_bytes(message.to_bytes(), message.receiver)  # Forward the message to the recipient
+    # Forward the received bytes to the recipient instead of encoding the message again
+    server.send_bytes(raw, message.receiver)
+
+
+def handle_offline_ack(server, message: Message, client: SSLSocket, addr: tuple[str, int]):
+    """Called when a client handled a page of its offline messages."""
+    last_id = message.dict().get("last_id")
+    if not isinstance(last_id, int):
+        debug(f"{message.sender} ({addr}) acknowledged offline messages without a valid id.")
+        return
+    server.delivery.acknowledge(message.sender, last_id)
@@ -10,8 +10,8 @@ def handle_reset(server, message: Message, client: SSLSocket, addr: tuple[str, i
 
     if receiver == "server":
         debug(f"{message.sender} ({addr}) sent a reset request.")
-        server.database.delete(message.sender)
-        for user in server.database.keys():
+        server.storage.delete_user(message.sender)
+        for user in server.storage.usernames().result():
             if server.is_logged_in(user):
                 server.send(user, {"sender": message.sender, "status": REQUEST}, RESET)
             else:
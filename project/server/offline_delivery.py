@@ -0,0 +1,196 @@
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from project.util.framing import FramedSocket
+from project.util.message import Message, OFFLINE_ACK
+from project.util.serializer import serializer
+from project.util.utils import debug
+
+
+class OfflineDelivery:
+    """
+    Delivers the offline messages of users who just logged in, one page at a time, in the background.
+    Logging in doesn't wait for the backlog, and a large backlog is never loaded into memory or written to a
+    connection at once. Users which are draining are served round-robin, one page per turn.
+    The delivery thread only reads pages and hands them to a pool of sender threads, so a client which doesn't read
+    only blocks the sender writing to it. A page has to be sent (and acknowledged) within ack_timeout seconds,
+    otherwise the connection of the client is shut down, which also releases a sender that is stuck writing to it.
+
+    Clients which announced "offline_acks" in their identity message get an OFFLINE_ACK message after every page and
+    answer it once they handled the page. Only then the page is deleted from the database and the next one is sent,
+    so a connection which is closed during the drain resumes with the first unacknowledged page with the next login.
+    A client which sent a page but doesn't acknowledge it in time stops draining. It receives new messages
+    right away again, and the rest of its backlog with the next login.
+    For other clients a page is deleted once it was written to the connection.
+
+    While a user is draining, messages for the user are stored behind the backlog instead of being sent right away,
+    so the user receives all messages in the order they were sent.
+    """
+
+    def __init__(self, server, page_size: int = 100, ack_timeout: float = 30, sender_threads: int = 8):
+        """
+        :param page_size: The number of messages sent before waiting for the client
+        :param ack_timeout: The number of seconds a client has to receive and acknowledge a page
+        :param sender_threads: The number of threads writing pages to connections
+        """
+        self.server = server
+        self.page_size: int = page_size
+        self.ack_timeout: float = ack_timeout
+        self.draining: dict[str, Optional[int]] = {}  # Users which are draining and the last id of the page in flight
+        self.deadlines: dict[str, float] = {}  # Users with a page in flight and until when it has to be acknowledged
+        self.sending: set[str] = set()  # Users whose page is still being written to the connection
+        self.acknowledging: set[str] = set()  # Connected users whose clients acknowledge pages
+        self.lock = threading.Lock()
+        self.turns: queue.Queue[Optional[str]] = queue.Queue()  # Users whose next page can be sent
+        self.senders = ThreadPoolExecutor(max_workers=sender_threads, thread_name_prefix="offline-sender")
+        self.thread = threading.Thread(target=self.run, daemon=True, name="offline-delivery")
+        self.thread.start()
+
+    def start(self, username: str):
+        """Starts delivering the offline messages of the user. Has to be called before the user is logged in."""
+        with self.lock:
+            if username in self.draining:
+                return
+            self.draining[username] = None
+        self.turns.put(username)
+
+    def stop(self, username: str):
+        """Stops the delivery to a user who disconnected. Unacknowledged pages stay in the database."""
+        with self.lock:
+            self.draining.pop(username, None)
+            self.deadlines.pop(username, None)
+            self.acknowledging.discard(username)
+
+    def store_if_draining(self, username: str, message: bytes) -> bool:
+        """
+        Stores a message behind the backlog of the user if the user is draining.
+        :return: Whether the message was stored and must not be sent right away
+        """
+        with self.lock:
+            if username not in self.draining:
+                return False
+            self.server.storage.add_offline_message(username, message)
+            return True
+
+    def acknowledge(self, username: str, last_id: int):
+        """Deletes the acknowledged page and sends the next one."""
+        with self.lock:
+            if username not in self.acknowledging or username not in self.draining or self.draining[username] != last_id:
+                debug(f"{username} acknowledged offline messages up to {last_id}, which weren't sent.")
+                return
+            self.finish_page(username, last_id)
+        self.turns.put(username)
+
+    def finish_page(self, username: str, last_id: int):
+        # The storage executes operations in order, so the next page is read after this page is deleted
+        self.server.storage.delete_offline_messages(username, last_id)
+        self.draining[username] = None
+        self.deadlines.pop(username, None)
+
+    def run(self):
+        while True:
+            try:
+                username = self.turns.get(timeout=min(self.ack_timeout, 1))
+            except queue.Empty:
+                self.expire_pages()
+                continue
+            if username is None:
+                return
+            try:
+                self.deliver_page(username)
+            except Exception:
+                traceback.print_exc()
+                debug(f"Failed to deliver offline messages to {username}.")
+                self.stop(username)
+            self.expire_pages()
+
+    def expire_pages(self):
+        """
+        Stops the drain of users who didn't receive or acknowledge their page in time. Their pages stay in the database.
+        Connections which still couldn't take the whole page are shut down.
+        """
+        now = time.monotonic()
+        with self.lock:
+            expired = [username for username, deadline in self.deadlines.items() if deadline < now]
+            for username in expired:
+                del self.deadlines[username]
+                self.draining.pop(username, None)
+            stuck = [username for username in expired if username in self.sending]
+        for username in expired:
+            debug(f"{username} didn't acknowledge offline messages in time. Sending the rest with the next login.")
+        for username in stuck:
+            connection = self.server.connection(username)
+            if connection:
+                debug(f"{username} doesn't read its offline messages. Closing the connection.")
+                connection.abort()
+
+    def deliver_page(self, username: str):
+        with self.lock:
+            # Stale turns of users who disconnected or have a page in flight are skipped
+            if username not in self.draining or self.draining[username] is not None:
+                return
+            acknowledges = username in self.acknowledging
+
+        page = self.server.storage.get_offline_messages(username, self.page_size).result()
+        if not page:
+            with self.lock:
+                # Messages stored since the page was read still have to be delivered before the drain ends
+                if username not in self.draining:
+                    return
+                if not self.server.storage.get_offline_messages(username, 1).result():
+                    del self.draining[username]
+                    debug(f"Delivered all offline messages to {username}.")
+                    return
+            self.turns.put(username)
+            return
+
+        connection: Optional[FramedSocket] = self.server.connection(username)
+        if connection is None:
+            self.stop(username)
+            return
+
+        last_id = page[-1][0]
+        with self.lock:
+            if username not in self.draining:
+                return
+            self.draining[username] = last_id
+            self.deadlines[username] = time.monotonic() + self.ack_timeout
+            self.sending.add(username)
+        self.senders.submit(self.send_page, username, connection, page, acknowledges)
+
+    def send_page(self, username: str, connection: FramedSocket, page: list[tuple[int, bytes]], acknowledges: bool):
+        """Writes a page to the connection, executed by the sender threads."""
+        last_id = page[-1][0]
+        try:
+            for _, message in page:
+                connection.send_frame(message)
+            if acknowledges:
+                ack = Message(serializer.encode_message({"last_id": last_id}), "server", username, OFFLINE_ACK)
+                connection.send_frame(ack.to_bytes())
+            else:
+                connection.drain()
+        except Exception:
+            debug(f"Failed to send offline messages to {username}.")
+            self.stop(username)
+            return
+        finally:
+            with self.lock:
+                self.sending.discard(username)
+        debug(f"Sent {len(page)} offline messages to {username}.")
+
+        if not acknowledges:
+            with self.lock:
+                # The user may have reconnected in the meantime, the page then belongs to the new connection
+                if self.draining.get(username) != last_id or self.server.connection(username) is not connection:
+                    return
+                self.finish_page(username, last_id)
+            self.turns.put(username)
+
+    def close(self):
+        self.turns.put(None)
+        self.thread.join()
+        self.senders.shutdown(wait=False, cancel_futures=True)
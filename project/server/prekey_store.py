@@ -0,0 +1,61 @@
+import threading
+import time
+from typing import Optional
+
+from ecdsa import VerifyingKey
+
+from project.util.message import Message, X3DH_REQUEST_KEYS
+from project.util.serializer import serializer
+from project.util.utils import debug
+
+
+class PrekeyStore:
+    """
+    Hands out the one-time prekeys of the users. Every claim removes exactly one key from the database.
+    Once a user has fewer than low_watermark keys left, new keys are requested from the user right away
+    (or with the next login if the user is offline), so key bundle requests don't fail while the user is generating them.
+    A request is repeated if the user didn't send keys within refill_timeout seconds or logged in again since,
+    as the request or the answer may have been lost.
+    """
+
+    def __init__(self, server, low_watermark: int = 3, refill_timeout: float = 60):
+        self.server = server
+        self.low_watermark: int = low_watermark
+        self.refill_timeout: float = refill_timeout
+        self.refill_requested: dict[str, float] = {}  # Users which were asked for new keys and haven't sent them yet, and when
+        self.lock = threading.Lock()
+
+    def claim(self, username: str) -> Optional[VerifyingKey]:
+        """
+        Claims the next one-time prekey of the user and requests new keys if the user is running low.
+        :param username: The name of the user
+        :return: The prekey or None if the user has none left
+        """
+        OPK, remaining = self.server.storage.claim_opk(username).result()
+        if remaining < self.low_watermark:
+            self.request_refill(username)
+        return OPK
+
+    def add(self, username: str, OPKs: list[VerifyingKey]):
+        self.server.storage.add_opks(username, OPKs).result()
+        with self.lock:
+            self.refill_requested.pop(username, None)
+
+    def reset_refill(self, username: str):
+        """Allows requesting new keys from the user right away, e.g. because the user logged in again."""
+        with self.lock:
+            self.refill_requested.pop(username, None)
+
+    def request_refill(self, username: str):
+        with self.lock:
+            requested = self.refill_requested.get(username)
+            if requested is not None and time.monotonic() - requested < self.refill_timeout:
+                return
+            self.refill_requested[username] = time.monotonic()
+
+        if self.server.is_logged_in(username):
+            debug(f"{username} is running out of one-time prekeys. Requesting new ones.")
+            self.server.send(username, {}, X3DH_REQUEST_KEYS)
+        else:
+            debug(f"{username} is running out of one-time prekeys and is offline. Requesting new ones with the next login.")
+            self.server.add_offline_message(username, Message(serializer.encode_message({}), "server", username, X3DH_REQUEST_KEYS))
@@ -1,37 +1,55 @@
+import asyncio
 import datetime
 import os
 import socket
 import ssl
+import sys
 import threading
 import traceback
-from ssl import SSLSocket
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 import project.server.handler.login_handler as login_handler
 import project.server.handler.message_handler as message_handler
 import project.server.handler.x3dh_handler as x3dh_handler
+from project.server.async_socket import AsyncClientSocket
+from project.server.offline_delivery import OfflineDelivery
 from project.server.handler import identity_handler, reset_handler
 from project.util.serializer import serializer
-from project.util.database import Database
+from project.server.prekey_store import PrekeyStore
+from project.server.sqlite_database import SqliteDatabase, migrate_json_database
+from project.server.storage_actor import StorageActor
+from project.util.database import Database, EncryptedDatabase, migrate_database
+from project.util.framing import FrameBuffer, FramedSocket, RECV_SIZE
 from project.util.message import MESSAGE, Message, REGISTER, REQUEST_SALT, IDENTITY, LOGIN, X3DH_BUNDLE_REQUEST, X3DH_FORWARD, X3DH_REQUEST_KEYS, \
-    is_valid_message, RESET
+    is_valid_message, RESET, OFFLINE_ACK
 from project.util.utils import debug
 
 
 class Server:
-    def __init__(self, host: str = "localhost", port: int = 25567):
+    def __init__(self, host: str = "localhost", port: int = 25567, use_asyncio: bool = False, handler_threads: int = 32):
+        """
+        :param handler_threads: The number of threads executing handlers in asyncio mode
+        """
         self.host: str = host
         self.port: int = port
+        self.use_asyncio: bool = use_asyncio  # Serve all clients on one event loop instead of one thread per client
+        self.handler_threads: int = handler_threads
+        # Handlers wait for the storage thread, so in asyncio mode they are executed by these threads instead of the event loop
+        self.handler_executor: Optional[ThreadPoolExecutor] = None
         self.server_socket: Optional[ssl.SSLSocket] = None
-        self.sockets: dict[tuple[str, int], ssl.SSLSocket] = {}  # List of connected clients (addr, socket)
+        self.sockets: dict[tuple[str, int], FramedSocket] = {}  # List of connected clients (addr, socket)
         self.connections: dict[str, tuple[str, int]] = {}  # List of connected clients (username, addr)
+        self.sessions: set[str] = set()  # Users which are logged in on one of the connections
 
-        self.database = Database("db/database.json")
-        self.peppers = Database("db/peppers.csv", "db/server-key-peppers.txt", True)
-
-        # Set all users to logged out (in case the server crashed)
-        for user in self.database.keys():
-            self.database.update(user, {"logged_in": False})
+        self.database = SqliteDatabase("db/database.sqlite")
+        migrate_json_database(self.database, "db/database.json")
+        self.storage = StorageActor(self.database)  # All handlers access the database through the storage thread
+        self.prekeys = PrekeyStore(self)
+        self.delivery = OfflineDelivery(self)  # Sends the offline messages after a login
+        self.peppers = EncryptedDatabase("db/peppers.json", "db/server-key-peppers.txt")
+        if os.path.exists("db/peppers.csv"):
+            migrate_database(Database("db/peppers.csv", "db/server-key-peppers.txt", True), self.peppers)
 
         self.login_attempts: dict[str, list[datetime.datetime]] = {}  # Dictionary to store login attempts
 
@@ -44,7 +62,8 @@ class Server:
             X3DH_BUNDLE_REQUEST: x3dh_handler.handle_x3dh_bundle_request,
             X3DH_FORWARD: x3dh_handler.handle_x3dh_forward,
             X3DH_REQUEST_KEYS: x3dh_handler.handle_x3dh_key_shortage,
-            RESET: reset_handler.handle_reset
+            RESET: reset_handler.handle_reset,
+            OFFLINE_ACK: message_handler.handle_offline_ack
         }
 
     def username(self, addr: tuple[str, int]) -> Optional[str]:
@@ -65,15 +84,16 @@ class Server:
         :param username: The name of the user
         :return: Whether the user is registered
         """
-        return self.database.has(username) and self.database.get(username).get("registered") == True
+        return self.storage.is_registered(username).result()
 
     def is_logged_in(self, username: str) -> bool:
         """
-        Checks if the user with the given name is currently logged in by checking if 'logged_in' is set to True.
+        Checks if the user with the given name is currently logged in.
+        Sessions only exist in memory, so all users are logged out when the server restarts.
         :param username: The name of the user
         :return: Whether the user is logged in
         """
-        return self.database.has(username) and self.database.get(username).get("logged_in") == True
+        return username in self.sessions
 
     def add_offline_message(self, username: str, message: Message):
         """
@@ -82,10 +102,7 @@ class Server:
         :param message: The message to add
         """
         if self.is_registered(username):
-            if "offline_messages" not in self.database.get(username):
-                self.database.update(username, {"offline_messages": [message]})
-            else:
-                self.database.get(username).get("offline_messages").append(message)
+            self.storage.add_offline_message(username, message.raw if message.raw is not None else message.to_bytes())
 
     def get_or_gen_salt(self, sender: str) -> bytes:
         """
@@ -94,13 +111,11 @@ class Server:
         :param sender: The name of the user
         :return: The user's salt
         """
-        has_salt = self.database.has(sender) and "salt" in self.database.get(sender)
+        salt = self.storage.get_field(sender, "salt").result()
 
-        if not has_salt:
+        if not salt:
             salt = os.urandom(32)
-            self.database.insert(sender, {"salt": salt})
-        else:
-            salt = self.database.get(sender).get("salt")
+            self.storage.set_field(sender, "salt", salt)
         return salt
 
 
@@ -127,7 +142,18 @@ class Server:
 
         self.login_attempts.get(username).append(datetime.datetime.now())
 
+    def create_ssl_context(self) -> ssl.SSLContext:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile="server.pem", keyfile="server.key")
+        return context
+
     def start(self):
+        if self.use_asyncio:
+            asyncio.run(self.start_async())
+        else:
+            self.start_threaded()
+
+    def start_threaded(self):
         try:
             # Set up raw socket
             raw_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -135,9 +161,7 @@ class Server:
             raw_socket.listen(5)
 
             # Wrap with SSL
-            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-            context.load_cert_chain(certfile="server.pem", keyfile="server.key")
-            self.server_socket = context.wrap_socket(raw_socket, server_side=True)
+            self.server_socket = self.create_ssl_context().wrap_socket(raw_socket, server_side=True)
 
             debug(f"Server started on {self.host}:{self.port}")
 
@@ -154,39 +178,56 @@ class Server:
             if self.server_socket:
                 self.server_socket.close()
 
-    def broadcast(self, message: bytes, sender_socket: ssl.SSLSocket):
+    async def start_async(self):
+        self.handler_executor = ThreadPoolExecutor(max_workers=self.handler_threads, thread_name_prefix="handler")
+        try:
+            server = await asyncio.start_server(self.handle_client_async, self.host, self.port, ssl=self.create_ssl_context())
+            debug(f"Server started on {self.host}:{self.port} (asyncio)")
+            async with server:
+                await server.serve_forever()
+        except Exception:
+            traceback.print_exc()
+            debug("Error starting the server.")
+        finally:
+            self.handler_executor.shutdown(wait=False)
+
+    def broadcast(self, message: bytes, sender_socket: FramedSocket):
         for client in self.sockets.values():
             if client != sender_socket:
                 try:
-                    client.send(message)
+                    client.send_frame(message)
                 except Exception:
                     traceback.print_exc()
                     debug("Failed to send message to a client.")
 
-    def send_bytes(self, message: bytes, recipient: tuple[str, int] | str | SSLSocket) -> bool:
+    def connection(self, username: str) -> Optional[FramedSocket]:
+        """Returns the socket of the user or None if the user is not connected."""
+        addr = self.connections.get(username)
+        return self.sockets.get(addr) if addr else None
+
+    def send_bytes(self, message: bytes, recipient: tuple[str, int] | str | FramedSocket) -> bool:
         target = None
         if isinstance(recipient, tuple):
             if recipient in self.sockets:
                 target = self.sockets[recipient]
         elif isinstance(recipient, str):
-            if recipient in self.connections and self.connections[recipient] in self.sockets:
-                target = self.sockets[self.connections[recipient]]
-        elif isinstance(recipient, SSLSocket):
+            target = self.connection(recipient)
+        elif isinstance(recipient, FramedSocket):
             target = recipient
 
         if target is None:
-            debug(f"Client {recipient if not isinstance(recipient, SSLSocket) else recipient.getpeername()} not found.")
+            debug(f"Client {recipient if not isinstance(recipient, FramedSocket) else recipient.getpeername()} not found.")
             return False
 
         try:
-            target.send(message)
+            target.send_frame(message)
             return True
         except Exception:
             traceback.print_exc()
             debug("Failed to send the message.")
             return False
 
-    def send(self, receiver: str | Optional[ssl.SSLSocket], content: dict[str, any], type: str = MESSAGE):
+    def send(self, receiver: str | Optional[FramedSocket], content: dict[str, any], type: str = MESSAGE):
         try:
             message = Message(
                 message=serializer.encode_message(content),
@@ -200,61 +241,117 @@ class Server:
             debug(f"Failed to send the message to {receiver}.")
 
     def handle_client(self, client_socket: ssl.SSLSocket, addr: tuple[str, int]):
+        connection = FramedSocket(client_socket)
         try:
 
             debug(f"Handling client {addr}. Checking it's identity.")
-            if not identity_handler.check_identity(self, client_socket, addr):
-                return
+            username = None
 
-            username = self.username(addr)
+            while True:
+                frames = connection.recv_frames()
+                if frames is None:
+                    debug(f"Received empty byte message from {addr}. Closing connection.")
+                    break
+                if not self.handle_frames(frames, connection, addr, username):
+                    break
+                username = self.username(addr)
+        except Exception as e:
+            debug(f"Error with client {addr}: {e}")
+        finally:
+            self.close_client(connection, addr)
+
+    async def handle_client_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = FramedSocket(AsyncClientSocket(writer))
+        addr = connection.getpeername()
+        loop = asyncio.get_running_loop()
+        debug(f"New connection from {addr}")
+        try:
+
+            debug(f"Handling client {addr}. Checking it's identity.")
+            buffer = FrameBuffer()
+            username = None
 
             while True:
-                received_bytes = client_socket.recv(8192)
+                received_bytes = await reader.read(RECV_SIZE)
                 if not received_bytes:
                     debug(f"Received empty byte message from {addr}. Closing connection.")
                     break
-                message = Message.from_bytes(received_bytes)
-
-                # Check if message can be decoded and has valid fields
-                if is_valid_message(message):
-
-                    # Check if the user tries to send a message as another user
-                    if not message.sender == username:
-                        debug(f"{message.sender} ({addr}) tried to send a message as {username}.")
-                        break
-
-                    # Check if the user is logged in (except for messages required to log in)
-                    if not self.is_logged_in(message.sender) and message.type not in [IDENTITY, REGISTER, LOGIN, REQUEST_SALT]:
-                        debug(f"{message.sender} ({addr}) tried to send a message with type '{message.type}' without being logged in.")
-                        break
-
-                    # Only messages of type MESSAGE can be sent to other clients
-                    if message.receiver != "server" and message.type != MESSAGE:
-                        debug(f"{message.sender} ({addr}) tried to send a non-message type message to {message.receiver}.")
-                        continue
-
-                    # Execute the handler for the message type
-                    handler = self.handlers.get(message.type, self.handle_unknown)
-                    handler(self, message, client_socket, addr)
-                else:
-                    debug(f"Client {addr} sent an invalid message. Closing connection.")
+                # The frames of one connection are handled in order, the next read waits until they were handled
+                frames = buffer.feed(received_bytes)
+                if frames and not await loop.run_in_executor(self.handler_executor, self.handle_frames, frames, connection, addr, username):
                     break
+                username = self.username(addr)
+                await writer.drain()
         except Exception as e:
             debug(f"Error with client {addr}: {e}")
         finally:
-            # Close connection and log out user
-            client_socket.close()
-            username = self.username(addr)
-            if username:
-                self.database.update(username, {"logged_in": False})
-                self.connections.pop(username, None)
-            self.sockets.pop(addr, None)
-            debug(f"Connection with {addr} closed.")
-
-    def handle_unknown(self, message: Message, client: SSLSocket, addr: tuple[str, int]):
+            self.close_client(connection, addr)
+
+    def handle_frames(self, frames: list[bytes], connection: FramedSocket, addr: tuple[str, int], username: Optional[str]) -> bool:
+        """
+        Handles all frames received in one read. The first frame of a connection has to be the identity message.
+        :return: Whether the connection should be kept open
+        """
+        for received_bytes in frames:
+            if username is None:
+                if not identity_handler.check_identity(self, connection, addr, received_bytes):
+                    return False
+                username = self.username(addr)
+            elif not self.handle_bytes(received_bytes, connection, addr, username):
+                return False
+        return True
+
+    def handle_bytes(self, received_bytes: bytes, client_socket: FramedSocket, addr: tuple[str, int], username: str) -> bool:
+        """
+        Decodes a message received from a client and executes the handler for its type.
+        Used by both server modes.
+        :return: Whether the connection should be kept open
+        """
+        message = Message.from_bytes(received_bytes)
+
+        # Check if message header can be decoded and has valid fields
+        # The content is only decoded by handlers which need it, chat messages are relayed without decoding it
+        if not is_valid_message(message, decode_content=False):
+            debug(f"Client {addr} sent an invalid message. Closing connection.")
+            return False
+
+        # Check if the user tries to send a message as another user
+        if not message.sender == username:
+            debug(f"{message.sender} ({addr}) tried to send a message as {username}.")
+            return False
+
+        # Check if the user is logged in (except for messages required to log in)
+        if not self.is_logged_in(message.sender) and message.type not in [IDENTITY, REGISTER, LOGIN, REQUEST_SALT]:
+            debug(f"{message.sender} ({addr}) tried to send a message with type '{message.type}' without being logged in.")
+            return False
+
+        # Only messages of type MESSAGE can be sent to other clients
+        if message.receiver != "server" and message.type != MESSAGE:
+            debug(f"{message.sender} ({addr}) tried to send a non-message type message to {message.receiver}.")
+            return True
+
+        # Execute the handler for the message type
+        handler = self.handlers.get(message.type, self.handle_unknown)
+        handler(self, message, client_socket, addr)
+        return True
+
+    def close_client(self, client_socket: FramedSocket, addr: tuple[str, int]):
+        # Close connection and log out user
+        client_socket.close()
+        username = self.username(addr)
+        if username:
+            self.sessions.discard(username)
+            self.delivery.stop(username)
+            self.connections.pop(username, None)
+        self.sockets.pop(addr, None)
+        if client_socket.compressor:
+            debug(f"Compression ({client_socket.compressor.mode}) for {addr}: {client_socket.compressor.stats}")
+        debug(f"Connection with {addr} closed.")
+
+    def handle_unknown(self, message: Message, client: FramedSocket, addr: tuple[str, int]):
         debug(f"{message.sender} ({addr}) sent message of unknown type '{message.type}'.")
 
 
 if __name__ == "__main__":
-    server = Server()
+    server = Server(use_asyncio="--asyncio" in sys.argv)
     server.start()
@@ -0,0 +1,215 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+
+from ecdsa import VerifyingKey
+
+from project.util import crypto_utils
+from project.util.database import LogDatabase
+from project.util.message import Message
+from project.util.utils import debug
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    salt BLOB,
+    salted_password BLOB,
+    registered INTEGER NOT NULL DEFAULT 0,
+    IPK BLOB,
+    SPK BLOB,
+    sigma BLOB
+);
+CREATE TABLE IF NOT EXISTS prekeys (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    key BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS prekeys_username ON prekeys (username, id);
+CREATE TABLE IF NOT EXISTS offline_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    message BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS offline_messages_username ON offline_messages (username, id);
+"""
+
+USER_FIELDS = ["salt", "salted_password", "registered"]  # Columns which can be read and written by name
+
+
+class SqliteDatabase:
+    """
+    Server database with one row per user, one row per one-time prekey and one row per offline message.
+    Every operation only reads and writes the rows of the users involved, so nothing has to be kept in memory.
+    On the server, the database is only used by the thread of the StorageActor. Statements are still executed while
+    holding a lock, so the database can be used from other threads as well, e.g. for migrations.
+    """
+
+    def __init__(self, path: str):
+        self.path: str = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.RLock()
+
+    def execute(self, sql: str, parameters: tuple = ()) -> list[tuple]:
+        """Executes the statement and returns all resulting rows."""
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def transaction(self, statements: list[tuple[str, tuple]]):
+        """
+        Executes the statements in one transaction.
+        A savepoint is used, so the statements can also be part of a larger transaction.
+        :param statements: A list of (sql, parameters) tuples
+        """
+        with self.lock:
+            self.connection.execute("SAVEPOINT statements")
+            try:
+                for sql, parameters in statements:
+                    self.connection.execute(sql, parameters)
+                self.connection.execute("RELEASE statements")
+            except Exception:
+                self.connection.execute("ROLLBACK TO statements")
+                self.connection.execute("RELEASE statements")
+                raise
+
+    def has_user(self, username: str) -> bool:
+        return len(self.execute("SELECT 1 FROM users WHERE username = ?", (username,))) > 0
+
+    def usernames(self) -> list[str]:
+        return [row[0] for row in self.execute("SELECT username FROM users")]
+
+    def get_field(self, username: str, field: str):
+        """
+        Returns a single column of the user's row.
+        :param username: The name of the user
+        :param field: The column, one of salt, salted_password and registered
+        :return: The value or None if the user doesn't exist
+        """
+        if field not in USER_FIELDS:
+            raise ValueError(f"Unknown field {field}")
+        rows = self.execute(f"SELECT {field} FROM users WHERE username = ?", (username,))
+        return rows[0][0] if rows else None
+
+    def set_field(self, username: str, field: str, value):
+        """Sets a single column of the user's row, creating the row if the user doesn't exist yet."""
+        if field not in USER_FIELDS:
+            raise ValueError(f"Unknown field {field}")
+        self.execute(f"INSERT INTO users (username, {field}) VALUES (?, ?) ON CONFLICT (username) DO UPDATE SET {field} = excluded.{field}", (username, value))
+
+    def is_registered(self, username: str) -> bool:
+        return self.get_field(username, "registered") == 1
+
+    def register(self, username: str, salted_password: bytes, key_bundle: dict):
+        """
+        Stores the password and the key bundle of the user and marks the user as registered.
+        :param key_bundle: The key bundle with IPK, SPK, sigma and the list of OPKs
+        """
+        statements = [(
+            "INSERT INTO users (username, salted_password, registered, IPK, SPK, sigma) VALUES (?, ?, 1, ?, ?, ?) "
+            "ON CONFLICT (username) DO UPDATE SET salted_password = excluded.salted_password, registered = 1, "
+            "IPK = excluded.IPK, SPK = excluded.SPK, sigma = excluded.sigma",
+            (username, salted_password, crypto_utils.encode_public_key(key_bundle["IPK"]),
+             crypto_utils.encode_public_key(key_bundle["SPK"]), key_bundle["sigma"])
+        ), ("DELETE FROM prekeys WHERE username = ?", (username,))]
+        statements += [("INSERT INTO prekeys (username, key) VALUES (?, ?)", (username, crypto_utils.encode_public_key(OPK)))
+                       for OPK in key_bundle.get("OPKs", [])]
+        self.transaction(statements)
+
+    def get_key_bundle(self, username: str) -> Optional[dict]:
+        """Returns the IPK, SPK and sigma of the user or None if the user has no keys."""
+        rows = self.execute("SELECT IPK, SPK, sigma FROM users WHERE username = ?", (username,))
+        if not rows or rows[0][0] is None:
+            return None
+        row = rows[0]
+        return {"IPK": crypto_utils.decode_public_key(row[0]), "SPK": crypto_utils.decode_public_key(row[1]), "sigma": row[2]}
+
+    def claim_opk(self, username: str) -> tuple[Optional[VerifyingKey], int]:
+        """
+        Removes the oldest one-time prekey of the user and returns it. Removing and returning the key is one statement,
+        so a key can never be handed out twice.
+        :return: The prekey or None if the user has none left and the number of prekeys the user has left
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "DELETE FROM prekeys WHERE id = (SELECT id FROM prekeys WHERE username = ? ORDER BY id LIMIT 1) RETURNING key", (username,)
+            ).fetchall()
+            remaining = self.count_opks(username)
+        return (crypto_utils.decode_public_key(rows[0][0]) if rows else None), remaining
+
+    def add_opks(self, username: str, OPKs: list[VerifyingKey]):
+        self.transaction([("INSERT INTO prekeys (username, key) VALUES (?, ?)", (username, crypto_utils.encode_public_key(OPK))) for OPK in OPKs])
+
+    def count_opks(self, username: str) -> int:
+        return self.execute("SELECT COUNT(*) FROM prekeys WHERE username = ?", (username,))[0][0]
+
+    def add_offline_message(self, username: str, message: bytes):
+        self.execute("INSERT INTO offline_messages (username, message) VALUES (?, ?)", (username, message))
+
+    def get_offline_messages(self, username: str, limit: int = -1) -> list[tuple[int, bytes]]:
+        """
+        Returns the offline messages of the user as (id, message) tuples in the order they were added.
+        :param limit: The maximum number of messages, -1 for all of them
+        """
+        return self.execute("SELECT id, message FROM offline_messages WHERE username = ? ORDER BY id LIMIT ?", (username, limit))
+
+    def delete_offline_messages(self, username: str, last_id: int):
+        """Deletes the offline messages of the user up to and including the message with the given id."""
+        self.execute("DELETE FROM offline_messages WHERE username = ? AND id <= ?", (username, last_id))
+
+    def delete_user(self, username: str):
+        self.transaction([
+            ("DELETE FROM users WHERE username = ?", (username,)),
+            ("DELETE FROM prekeys WHERE username = ?", (username,)),
+            ("DELETE FROM offline_messages WHERE username = ?", (username,))
+        ])
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def migrate_json_database(database: SqliteDatabase, json_path: str) -> bool:
+    """
+    Copies all users of the old JSON database (including its log) into the SQLite database.
+    The old files are renamed afterward, so the migration only runs once.
+    :param database: The SQLite database
+    :param json_path: The path of the old JSON database
+    :return: Whether a database was migrated
+    """
+    if not Path(json_path).exists() and not Path(json_path + ".log").exists():
+        return False
+
+    old = LogDatabase(json_path)
+    statements = []
+    for username in old.keys():
+        user = old.get(username)
+        statements.append((
+            "INSERT OR REPLACE INTO users (username, salt, salted_password, registered) VALUES (?, ?, ?, ?)",
+            (username, user.get("salt"), user.get("salted_password"), int(user.get("registered") == True))
+        ))
+
+        keys = user.get("keys")
+        if keys:
+            statements.append(("UPDATE users SET IPK = ?, SPK = ?, sigma = ? WHERE username = ?", (
+                crypto_utils.encode_public_key(keys["IPK"]), crypto_utils.encode_public_key(keys["SPK"]), keys["sigma"], username
+            )))
+            statements += [("INSERT INTO prekeys (username, key) VALUES (?, ?)", (username, crypto_utils.encode_public_key(OPK)))
+                           for OPK in keys.get("OPKs", [])]
+
+        for message in user.get("offline_messages", []):
+            message_bytes = message.to_bytes() if isinstance(message, Message) else message
+            statements.append(("INSERT INTO offline_messages (username, message) VALUES (?, ?)", (username, message_bytes)))
+
+    database.transaction(statements)
+    old.close()
+
+    for path in [json_path, json_path + ".log"]:
+        if Path(path).exists():
+            os.replace(path, path + ".migrated")
+    debug(f"Migrated {len(old.keys())} users from {json_path} to {database.path}.")
+    return True
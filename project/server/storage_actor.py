@@ -0,0 +1,131 @@
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+from typing import Optional
+
+from ecdsa import VerifyingKey
+
+from project.server.sqlite_database import SqliteDatabase
+from project.util.utils import debug
+
+
+class StorageActor:
+    """
+    Owns the server database and executes all operations on it in one thread.
+    Handlers submit operations from any thread and get a future for the result. Operations are executed in the order
+    they were submitted, so a handler always reads what it wrote before, even without waiting for its writes.
+    All operations which are waiting when the thread becomes idle are executed in one transaction. Their futures
+    are completed after the transaction is committed.
+    """
+
+    def __init__(self, database: SqliteDatabase, batch_size: int = 256):
+        self.database: SqliteDatabase = database
+        self.batch_size: int = batch_size
+        self.operations: queue.Queue[Optional[tuple[Future, str, tuple]]] = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True, name="storage")
+        self.thread.start()
+
+    def submit(self, operation: str, *args) -> Future:
+        """
+        Queues an operation of the database.
+        :param operation: The name of the SqliteDatabase method
+        :param args: The arguments of the method
+        :return: A future which is completed with the result of the method once it is committed
+        """
+        future = Future()
+        self.operations.put((future, operation, args))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.operations.get()]
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.operations.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            if batch:
+                self.execute_batch(batch)
+            if stop:
+                return
+
+    def execute_batch(self, batch: list[tuple[Future, str, tuple]]):
+        results = []
+        connection = self.database.connection
+        with self.database.lock:
+            connection.execute("BEGIN")
+            for future, operation, args in batch:
+                # A failing operation only rolls back its own changes
+                connection.execute("SAVEPOINT operation")
+                try:
+                    results.append((future, getattr(self.database, operation)(*args), None))
+                    connection.execute("RELEASE operation")
+                except Exception as e:
+                    connection.execute("ROLLBACK TO operation")
+                    connection.execute("RELEASE operation")
+                    traceback.print_exc()
+                    debug(f"Storage operation {operation} failed.")
+                    results.append((future, None, e))
+            try:
+                connection.execute("COMMIT")
+            except Exception as e:
+                connection.execute("ROLLBACK")
+                results = [(future, None, e) for future, _, _ in results]
+
+        for future, result, exception in results:
+            if exception:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        """Executes all queued operations and stops the thread."""
+        self.operations.put(None)
+        self.thread.join()
+
+    def has_user(self, username: str) -> Future:
+        return self.submit("has_user", username)
+
+    def usernames(self) -> Future:
+        return self.submit("usernames")
+
+    def get_field(self, username: str, field: str) -> Future:
+        return self.submit("get_field", username, field)
+
+    def set_field(self, username: str, field: str, value) -> Future:
+        return self.submit("set_field", username, field, value)
+
+    def is_registered(self, username: str) -> Future:
+        return self.submit("is_registered", username)
+
+    def register(self, username: str, salted_password: bytes, key_bundle: dict) -> Future:
+        return self.submit("register", username, salted_password, key_bundle)
+
+    def get_key_bundle(self, username: str) -> Future:
+        return self.submit("get_key_bundle", username)
+
+    def claim_opk(self, username: str) -> Future:
+        return self.submit("claim_opk", username)
+
+    def add_opks(self, username: str, OPKs: list[VerifyingKey]) -> Future:
+        return self.submit("add_opks", username, OPKs)
+
+    def count_opks(self, username: str) -> Future:
+        return self.submit("count_opks", username)
+
+    def add_offline_message(self, username: str, message: bytes) -> Future:
+        return self.submit("add_offline_message", username, message)
+
+    def get_offline_messages(self, username: str, limit: int = -1) -> Future:
+        return self.submit("get_offline_messages", username, limit)
+
+    def delete_offline_messages(self, username: str, last_id: int) -> Future:
+        return self.submit("delete_offline_messages", username, last_id)
+
+    def delete_user(self, username: str) -> Future:
+        return self.submit("delete_user", username)
@@ -0,0 +1,233 @@
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+from typing import Any, Optional
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from ecdsa import ECDH, SigningKey, VerifyingKey, der, util
+from ecdsa.curves import NIST256p
+from ecdsa.ellipticcurve import PointJacobi
+
+
+class CryptoProvider:
+    """
+    Implementation of the elliptic curve operations on P-256 used by the protocol.
+    All providers use the same encodings (compressed points, 32 byte private keys, DER signatures and PEM as written by ecdsa),
+    so users with different providers can talk to each other and databases can be opened with any provider.
+    """
+    name: str = ""
+    private_key_types: tuple[type, ...] = ()
+    public_key_types: tuple[type, ...] = ()
+    fast_key_generation: bool = False  # Whether generating keys is cheap enough to not need a process pool
+
+    def generate_key_pair(self) -> tuple[Any, Any]:
+        raise NotImplementedError
+
+    def public_key(self, private_key: Any) -> Any:
+        raise NotImplementedError
+
+    def dh(self, private_key: Any, public_key: Any) -> bytes:
+        """Returns the x coordinate of public_key * private_key."""
+        raise NotImplementedError
+
+    def sign(self, message: bytes, private_key: Any, nonce: Optional[int] = None) -> bytes:
+        """Signs the SHA-256 hash of the message and returns the DER encoded signature."""
+        raise NotImplementedError
+
+    def verify(self, signature: bytes, message: bytes, public_key: Any) -> bool:
+        raise NotImplementedError
+
+    def encode_public_key(self, key: Any) -> bytes:
+        """Encodes the public key as compressed point (33 bytes)."""
+        raise NotImplementedError
+
+    def decode_public_key(self, encoded: bytes) -> Any:
+        raise NotImplementedError
+
+    def encode_private_key(self, key: Any) -> bytes:
+        """Encodes the private key as 32 byte big-endian integer."""
+        raise NotImplementedError
+
+    def decode_private_key(self, encoded: bytes) -> Any:
+        raise NotImplementedError
+
+    def public_key_der(self, key: Any) -> bytes:
+        """Encodes the public key as DER SubjectPublicKeyInfo with an uncompressed point."""
+        raise NotImplementedError
+
+    def public_key_pem(self, key: Any) -> bytes:
+        # The PEM formatting of ecdsa is part of the protocol (signatures and associated data), so all providers use it
+        return der.topem(self.public_key_der(key), "PUBLIC KEY")
+
+    def precompute(self, key: Any) -> Any:
+        """
+        Hints that the public key is long-lived (e.g. the IPK or SPK of a peer) and will be used in many operations.
+        :return: A key which should be used instead of the given key, possibly with precomputed tables
+        """
+        return key
+
+
+class PrecomputeCache:
+    """
+    Keeps ecdsa public keys with precomputed multiplication tables. Multiplying a point with a table is about 5 times
+    faster, but building the table costs as much as 4 multiplications and about 35 KB of memory. So a table is only
+    built once a key was hinted a few times, and only the most recently used tables are kept.
+    """
+
+    def __init__(self, max_keys: int = 64, threshold: int = 2):
+        """
+        :param max_keys: The number of tables which are kept
+        :param threshold: The number of hints after which a table is built for a key
+        """
+        self.max_keys: int = max_keys
+        self.threshold: int = threshold
+        self.keys: OrderedDict[bytes, VerifyingKey] = OrderedDict()
+        self.hints: OrderedDict[bytes, int] = OrderedDict()  # Hints of keys without a table, also bounded
+        self.lock = threading.Lock()
+
+    def get(self, key: VerifyingKey) -> VerifyingKey:
+        """Returns the key with a precomputed table if it has one or has been hinted often enough, otherwise the key itself."""
+        encoded = key.to_string("compressed")
+        with self.lock:
+            if encoded in self.keys:
+                self.keys.move_to_end(encoded)
+                return self.keys[encoded]
+            hints = self.hints.pop(encoded, 0) + 1
+            if hints < self.threshold:
+                self.hints[encoded] = hints
+                if len(self.hints) > self.max_keys * 16:
+                    self.hints.popitem(last=False)
+                return key
+
+        # Building the table takes a while, so other threads can use the cache in the meantime
+        point = key.pubkey.point
+        precomputed = VerifyingKey.from_public_point(
+            PointJacobi(NIST256p.curve, point.x(), point.y(), 1, NIST256p.order, generator=True),
+            NIST256p, validate_point=False
+        )
+        precomputed.pubkey.point * 2  # Builds the table, see VerifyingKey.precompute
+
+        with self.lock:
+            self.keys[encoded] = precomputed
+            while len(self.keys) > self.max_keys:
+                self.keys.popitem(last=False)
+        return precomputed
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+            self.hints.clear()
+
+
+class EcdsaProvider(CryptoProvider):
+    """Provider using the pure Python ecdsa package."""
+    name = "ecdsa"
+    private_key_types = (SigningKey,)
+    public_key_types = (VerifyingKey,)
+
+    def __init__(self):
+        self.precomputed = PrecomputeCache()
+
+    def generate_key_pair(self) -> tuple[SigningKey, VerifyingKey]:
+        sk = SigningKey.generate(NIST256p)
+        return sk, sk.get_verifying_key()
+
+    def public_key(self, private_key: SigningKey) -> VerifyingKey:
+        return private_key.get_verifying_key()
+
+    def dh(self, private_key: SigningKey, public_key: VerifyingKey) -> bytes:
+        ecdh = ECDH(NIST256p)
+        ecdh.load_private_key(private_key)
+        ecdh.load_received_public_key(public_key)
+        return ecdh.generate_sharedsecret_bytes()
+
+    def sign(self, message: bytes, private_key: SigningKey, nonce: Optional[int] = None) -> bytes:
+        if nonce:  # If the nonce is explicitly specified
+            return private_key.sign(message, k=nonce, hashfunc=sha256, sigencode=util.sigencode_der)
+        return private_key.sign(message, hashfunc=sha256, sigencode=util.sigencode_der)
+
+    def verify(self, signature: bytes, message: bytes, public_key: VerifyingKey) -> bool:
+        try:
+            return public_key.verify(signature, message, hashfunc=sha256, sigdecode=util.sigdecode_der)
+        except:
+            return False
+
+    def encode_public_key(self, key: VerifyingKey) -> bytes:
+        return key.to_string("compressed")
+
+    def decode_public_key(self, encoded: bytes) -> VerifyingKey:
+        return VerifyingKey.from_string(encoded, curve=NIST256p)
+
+    def encode_private_key(self, key: SigningKey) -> bytes:
+        return key.to_string()
+
+    def decode_private_key(self, encoded: bytes) -> SigningKey:
+        return SigningKey.from_string(encoded, curve=NIST256p)
+
+    def public_key_der(self, key: VerifyingKey) -> bytes:
+        return key.to_der()
+
+    def public_key_pem(self, key: VerifyingKey) -> bytes:
+        return key.to_pem()
+
+    def precompute(self, key: VerifyingKey) -> VerifyingKey:
+        if not isinstance(key, VerifyingKey):
+            return key
+        return self.precomputed.get(key)
+
+
+class CryptographyProvider(CryptoProvider):
+    """Provider using the OpenSSL bindings of the cryptography package."""
+    name = "cryptography"
+    private_key_types = (ec.EllipticCurvePrivateKey,)
+    public_key_types = (ec.EllipticCurvePublicKey,)
+    fast_key_generation = True
+
+    def __init__(self):
+        self.curve = ec.SECP256R1()
+        self.signature_algorithm = ec.ECDSA(hashes.SHA256())
+
+    def generate_key_pair(self) -> tuple[ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey]:
+        private_key = ec.generate_private_key(self.curve)
+        return private_key, private_key.public_key()
+
+    def public_key(self, private_key: ec.EllipticCurvePrivateKey) -> ec.EllipticCurvePublicKey:
+        return private_key.public_key()
+
+    def dh(self, private_key: ec.EllipticCurvePrivateKey, public_key: ec.EllipticCurvePublicKey) -> bytes:
+        return private_key.exchange(ec.ECDH(), public_key)
+
+    def sign(self, message: bytes, private_key: ec.EllipticCurvePrivateKey, nonce: Optional[int] = None) -> bytes:
+        if nonce:
+            raise ValueError("The cryptography provider doesn't support explicit nonces.")
+        return private_key.sign(message, self.signature_algorithm)
+
+    def verify(self, signature: bytes, message: bytes, public_key: ec.EllipticCurvePublicKey) -> bool:
+        try:
+            public_key.verify(signature, message, self.signature_algorithm)
+            return True
+        except (InvalidSignature, ValueError):
+            return False
+
+    def encode_public_key(self, key: ec.EllipticCurvePublicKey) -> bytes:
+        return key.public_bytes(serialization.Encoding.X962, serialization.PublicFormat.CompressedPoint)
+
+    def decode_public_key(self, encoded: bytes) -> ec.EllipticCurvePublicKey:
+        return ec.EllipticCurvePublicKey.from_encoded_point(self.curve, encoded)
+
+    def encode_private_key(self, key: ec.EllipticCurvePrivateKey) -> bytes:
+        return key.private_numbers().private_value.to_bytes(32, "big")
+
+    def decode_private_key(self, encoded: bytes) -> ec.EllipticCurvePrivateKey:
+        return ec.derive_private_key(int.from_bytes(encoded, "big"), self.curve)
+
+    def public_key_der(self, key: ec.EllipticCurvePublicKey) -> bytes:
+        return key.public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+PROVIDERS: dict[str, type[CryptoProvider]] = {
+    EcdsaProvider.name: EcdsaProvider,
+    CryptographyProvider.name: CryptographyProvider
+}
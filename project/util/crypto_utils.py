@@ -1,15 +1,106 @@
 import hmac
 import os
+from functools import lru_cache
 from hashlib import sha256
-from typing import Tuple
+from typing import Any, Optional, Tuple
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives.hashes import SHA256
-from cryptography.hazmat.primitives.kdf.hkdf import HKDF
-from ecdsa import SigningKey, VerifyingKey, ECDH, util
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from ecdsa import SigningKey, VerifyingKey
 from ecdsa.curves import NIST256p as CURVE
 
+from project.util.crypto_provider import CryptoProvider, PROVIDERS
+
+
+PUBLIC_KEY_CACHE_SIZE = 4096
+HASH_LENGTH = 32
+TAG_LENGTH = 16
+
+# Provider of the elliptic curve operations, can be selected with the environment variable CRYPTO_PROVIDER
+provider: CryptoProvider = PROVIDERS[os.environ.get("CRYPTO_PROVIDER", "cryptography")]()
+
+
+def set_provider(name: str):
+    """
+    Selects the provider of the elliptic curve operations. Keys created before are converted when they are decoded,
+    but keys which are already in memory aren't, so this should be called before any keys are created or loaded.
+    :param name: The name of the provider, i.e. "ecdsa" or "cryptography"
+    """
+    global provider
+    provider = PROVIDERS[name]()
+    decode_public_key.cache_clear()
+    _public_key_pem.cache_clear()
+
+
+def is_public_key(value: Any) -> bool:
+    """Checks if the value is a public key of the selected provider."""
+    return isinstance(value, provider.public_key_types)
+
+
+def is_private_key(value: Any) -> bool:
+    return isinstance(value, provider.private_key_types)
+
+
+def encode_public_key(key: VerifyingKey) -> bytes:
+    """Encodes a public key as compressed point (33 bytes)."""
+    if not is_public_key(key):
+        return provider_of(key).encode_public_key(key)
+    return provider.encode_public_key(key)
+
+
+@lru_cache(maxsize=PUBLIC_KEY_CACHE_SIZE)
+def decode_public_key(encoded: bytes) -> VerifyingKey:
+    """
+    Decodes a public key encoded with encode_public_key.
+    Decoded keys are cached, so keys which are received often (e.g. the IPK and SPK of active users) are only parsed once.
+    """
+    return provider.decode_public_key(encoded)
+
+
+def encode_private_key(key: SigningKey) -> bytes:
+    """Encodes a private key as 32 byte integer."""
+    if not is_private_key(key):
+        return provider_of(key).encode_private_key(key)
+    return provider.encode_private_key(key)
+
+
+def decode_private_key(encoded: bytes) -> SigningKey:
+    return provider.decode_private_key(encoded)
+
+
+def convert_public_key(key: Any) -> VerifyingKey:
+    """Converts a public key of any provider to a key of the selected provider."""
+    return key if is_public_key(key) else decode_public_key(encode_public_key(key))
+
+
+def convert_private_key(key: Any) -> SigningKey:
+    return key if is_private_key(key) else decode_private_key(encode_private_key(key))
+
+
+def provider_of(key: Any) -> CryptoProvider:
+    """Returns a provider which can handle the key."""
+    for provider_type in PROVIDERS.values():
+        if isinstance(key, provider_type.private_key_types + provider_type.public_key_types):
+            return provider if isinstance(provider, provider_type) else provider_type()
+    raise TypeError(f"{type(key).__name__} is not a key of any crypto provider.")
+
+
+def precompute(key: VerifyingKey) -> VerifyingKey:
+    """
+    Hints that a public key is long-lived and used in many operations, e.g. the IPK and SPK of a peer.
+    The provider may return a key with precomputed tables (ecdsa does once a key is hinted repeatedly), which should be used instead.
+    """
+    return provider.precompute(key)
+
+
+def public_key_pem(key: VerifyingKey) -> bytes:
+    """Returns the PEM encoding of a public key, which is used for signatures and associated data."""
+    return _public_key_pem(encode_public_key(key))
+
+
+@lru_cache(maxsize=PUBLIC_KEY_CACHE_SIZE)
+def _public_key_pem(encoded: bytes) -> bytes:
+    return provider.public_key_pem(decode_public_key(encoded))
+
 
 def generate_one_time_pre_keys(amount: int):
     one_time_prekeys = []
@@ -20,9 +111,7 @@ def generate_one_time_pre_keys(amount: int):
 
 
 def generate_signature_key_pair() -> Tuple[SigningKey, VerifyingKey]:
-    sk = SigningKey.generate(CURVE)
-    vk = sk.get_verifying_key()
-    return sk, vk
+    return provider.generate_key_pair()
 
 
 def power_sk_vk(power: SigningKey, base: VerifyingKey):
@@ -32,41 +121,15 @@ def power_sk_vk(power: SigningKey, base: VerifyingKey):
     :param base: The public key to raise to the power
     :return: The shared secret (base^power)
     """
-    ecdh = ECDH(CURVE)
-    ecdh.load_private_key(power)
-    ecdh.load_received_public_key(base)
-    return ecdh.generate_sharedsecret_bytes()
+    return provider.dh(power, base)
 
 
 def ecdsa_sign(message: bytes, private_key: SigningKey, nonce=None):
-    signature = None
-    if nonce:  # If the nonce is explicitly specified
-        signature = private_key.sign(
-            message,
-            k=nonce,
-            hashfunc=sha256,
-            sigencode=util.sigencode_der
-        )
-    else:
-        signature = private_key.sign(
-            message,
-            hashfunc=sha256,
-            sigencode=util.sigencode_der
-        )
-    return signature
+    return provider.sign(message, private_key, nonce)
 
 
 def ecdsa_verify(signature: bytes, message: bytes, public_key: VerifyingKey):
-    try:
-        is_valid = public_key.verify(
-            signature,
-            message,
-            hashfunc=sha256,
-            sigdecode=util.sigdecode_der
-        )
-        return is_valid
-    except:
-        return False
+    return provider.verify(signature, message, public_key)
 
 
 def kdf_chain(ck: bytes) -> Tuple[bytes, bytes]:
@@ -74,53 +137,44 @@ def kdf_chain(ck: bytes) -> Tuple[bytes, bytes]:
     return derived[:32], derived[32:]
 
 
+def hkdf(salt: Optional[bytes], input_key_material: bytes, info: bytes, length: int) -> bytes:
+    """
+    HKDF with SHA-256 (RFC 5869), same output as HKDF of cryptography.
+    Creating a HKDF object of cryptography costs more than the derivation, so the two steps are done with hmac.
+    """
+    prk = hmac.digest(salt or bytes(HASH_LENGTH), input_key_material, "sha256")
+    output = b""
+    block = b""
+    counter = 1
+    while len(output) < length:
+        block = hmac.digest(prk, block + info + bytes([counter]), "sha256")
+        output += block
+        counter += 1
+    return output[:length]
+
+
 def hkdf_extract(salt: bytes, input_key_material: bytes, length=32):
-    hkdf_extract = HKDF(
-        algorithm=SHA256(),
-        length=length,
-        salt=salt,
-        info=None,
-        backend=default_backend()
-    )
-    prk = hkdf_extract.derive(input_key_material)
-    return prk
+    return hkdf(salt, input_key_material, b"", length)
 
 
 def hkdf_expand(prk: bytes, info: bytes, length=32):
-    hkdf_expand = HKDF(
-        algorithm=SHA256(),
-        length=length,
-        salt=None,
-        info=info,
-        backend=default_backend()
-    )
-    derived_key = hkdf_expand.derive(prk)
-    return derived_key
-
-def aes_gcm_encrypt(key: bytes, plaintext: bytes, associated_data: bytes) -> Tuple[bytes, bytes, bytes]:
-    iv = os.urandom(12)
-    encryptor = Cipher(
-        algorithms.AES(key),
-        modes.GCM(iv),
-        backend=default_backend()
-    ).encryptor()
-    encryptor.authenticate_additional_data(associated_data)
-
-    ciphertext = encryptor.update(plaintext) + encryptor.finalize()
-
-    return iv, ciphertext, encryptor.tag
+    return hkdf(None, prk, info, length)
+
+
+def aes_gcm_encrypt(key: bytes, plaintext: bytes, associated_data: bytes, iv: Optional[bytes] = None) -> Tuple[bytes, bytes, bytes]:
+    """
+    Encrypts the plaintext with AES-GCM.
+    :param iv: The nonce, a random nonce is used by default
+    :return: The nonce, the ciphertext and the tag
+    """
+    iv = iv or os.urandom(12)
+    encrypted = AESGCM(key).encrypt(iv, plaintext, associated_data)
+    return iv, encrypted[:-TAG_LENGTH], encrypted[-TAG_LENGTH:]
 
 
 def aes_gcm_decrypt(key: bytes, iv: bytes, ciphertext: bytes, associated_data: bytes, tag: bytes) -> bytes:
-    decryptor = Cipher(
-        algorithms.AES(key),
-        modes.GCM(iv, tag),
-        backend=default_backend()
-    ).decryptor()
-    decryptor.authenticate_additional_data(associated_data)
-    plaintext = decryptor.update(ciphertext) + decryptor.finalize()
-
-    return plaintext
+    """Decrypts a ciphertext of aes_gcm_encrypt, raises InvalidTag if it was tampered with."""
+    return AESGCM(key).decrypt(iv, ciphertext + tag, associated_data)
 
 
 def salt_password(password: str, salt: bytes, pepper: bytes) -> bytes:
@@ -1,11 +1,22 @@
+import atexit
 import csv
+import io
 import json
 import os
+import shutil
+import threading
+import traceback
 from pathlib import Path
 from typing import Any, Optional
 
 from project.util import crypto_utils
 from project.util.serializer import serializer
+from project.util.utils import debug
+
+# Durability policies, i.e. when saved changes are written and synced to disk
+DURABILITY_ALWAYS = "always"  # Every save is written and synced before it returns
+DURABILITY_PERIODIC = "periodic"  # Saves are collected and written and synced in batches by a background thread
+DURABILITY_SHUTDOWN = "shutdown"  # Saves are collected and written in batches by a background thread, but only synced on close
 
 
 def load_or_create_key(key_path: str):
@@ -21,6 +32,22 @@ def load_or_create_key(key_path: str):
     return key
 
 
+def atomic_write(path: str, content: str | bytes, sync: bool = True):
+    """
+    Writes the file by writing a temporary file and swapping it in place.
+    A crash while writing leaves the previous version of the file intact instead of a truncated file.
+    :param sync: Whether to wait until the content is on disk before swapping the files
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb" if isinstance(content, bytes) else "w") as file:
+        file.write(content)
+        file.flush()
+        if sync:
+            os.fsync(file.fileno())
+    os.replace(temporary_path, path)
+
+
 def decrypt_database(cipher: bytes, key: bytes, iv: bytes, tag: bytes) -> bytes:
     return crypto_utils.aes_gcm_decrypt(key, iv, cipher, b"DB", tag)
 
@@ -55,12 +82,34 @@ def decode_database(encoded: dict[str, str]) -> dict[str, Any]:
 
 
 class Database:
-    def __init__(self, path: str, key_path: Optional[str] = None, cipher: bool = False):
+    """
+    Database which keeps all entries in memory and writes them to one file.
+    With the durability policy DURABILITY_ALWAYS every save writes the file. With the other policies saves only mark
+    the changed entries and a background thread writes them once flush_after saves were made or flush_interval seconds passed.
+    """
+
+    def __init__(self, path: str, key_path: Optional[str] = None, cipher: bool = False, durability: str = DURABILITY_ALWAYS,
+                 flush_interval: float = 1.0, flush_after: int = 100):
         if cipher and not key_path:
             raise ValueError("Key path must be provided when cipher is enabled")
+        if durability not in [DURABILITY_ALWAYS, DURABILITY_PERIODIC, DURABILITY_SHUTDOWN]:
+            raise ValueError(f"Unknown durability policy {durability}")
         self.cipher = cipher
         self.key: bytes = load_or_create_key(key_path) if cipher else b""
         self.path: str = path
+        self.lock = threading.RLock()
+
+        self.durability: str = durability
+        self.flush_interval: float = flush_interval
+        self.flush_after: int = flush_after
+        self.pending: set[str] = set()  # Entries which were saved but not written yet
+        self.pending_all = False  # Whether a save without keys is pending
+        self.pending_saves = 0
+        self.unsynced = False  # Whether something was written without syncing it to disk
+        self.flush_requested = threading.Event()
+        self.flusher: Optional[threading.Thread] = None
+        self.closed = False
+
         self.data = self.load(path)
 
     def load(self, path: str):
@@ -71,6 +120,8 @@ class Database:
         Path(path).parent.mkdir(parents=True, exist_ok=True)
         with open(path, "r") as file:
             if self.cipher:
+                # The whole database is one field, which exceeds the default limit of the csv module with a few thousand entries
+                csv.field_size_limit(2 ** 31 - 1)
                 reader = csv.reader(file)
                 cipher: list[str] = reader.__next__()
                 iv: bytes = bytes.fromhex(cipher[0])
@@ -86,10 +137,12 @@ class Database:
         if not isinstance(key, (str, bytes)):
             raise TypeError("Key must be a string or bytes")
 
-        self.data[key if isinstance(key, str) else key.decode()] = value
+        key = key if isinstance(key, str) else key.decode()
+        with self.lock:
+            self.data[key] = value
 
         if save:
-            self.save()
+            self.save(key)
 
     def get(self, key: str | bytes) -> Any:
         if not isinstance(key, (str, bytes)):
@@ -100,29 +153,110 @@ class Database:
         if not isinstance(key, (str, bytes)):
             raise TypeError("Key must be a string or bytes")
 
-        if isinstance(value, dict) and key in self.data:
-            self.data[key if isinstance(key, str) else key.decode()].update(value)
-        else:
-            self.data[key if isinstance(key, str) else key.decode()] = value
+        key = key if isinstance(key, str) else key.decode()
+        with self.lock:
+            if isinstance(value, dict) and key in self.data:
+                self.data[key].update(value)
+            else:
+                self.data[key] = value
         if save:
-            self.save()
+            self.save(key)
 
     def delete(self, key: str | bytes, save: bool = True):
         if not isinstance(key, (str, bytes)):
             raise TypeError("Key must be a string or bytes")
-        self.data.pop(key if isinstance(key, str) else key.decode())
+        key = key if isinstance(key, str) else key.decode()
+        with self.lock:
+            self.data.pop(key)
+        if save:
+            self.save(key)
+
+    def save(self, *keys: str):
+        """
+        Saves the database, either right away or in the next batch depending on the durability policy.
+        :param keys: The entries which were changed, if known. Entries of mutable values that were changed in place have to be passed as well.
+        """
+        if self.durability == DURABILITY_ALWAYS:
+            # Writes take the locks they need, see flush
+            self.write(keys, True)
+            return
+
+        with self.lock:
+            if keys:
+                self.pending.update(keys)
+            else:
+                self.pending_all = True
+            self.pending_saves += 1
 
-    def save(self):
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.run_flusher, daemon=True)
+                self.flusher.start()
+                atexit.register(self.close)
+            if self.pending_saves >= self.flush_after:
+                self.flush_requested.set()
 
-        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
-        with open(self.path, "w") as file:
+    def write(self, keys: tuple[str, ...], sync: bool):
+        """
+        Writes the database to disk. This database always rewrites the whole file, subclasses may only write the given entries.
+        :param keys: The entries which were changed or an empty tuple if all entries should be written
+        :param sync: Whether to wait until the changes are on disk
+        """
+        with self.lock:
             if self.cipher:
+                file = io.StringIO()
                 writer = csv.writer(file)
                 encoded = serializer.encode_message(self.data)
                 iv, cipher, tag = encrypt_database(encoded, self.key)
                 writer.writerow([iv.hex(), cipher.hex(), tag.hex()])
+                atomic_write(self.path, file.getvalue(), sync)
             else:
-                file.write(json.dumps(encode_database(self.data), indent=4))
+                atomic_write(self.path, json.dumps(encode_database(self.data), indent=4), sync)
+            self.unsynced = self.unsynced or not sync
+
+    def sync(self):
+        """Makes sure everything which was written is on disk."""
+        self.write((), True)
+        self.unsynced = False
+
+    def flush(self):
+        """Writes all pending saves as one batch."""
+        with self.lock:
+            if not self.pending and not self.pending_all:
+                return
+            keys = () if self.pending_all else tuple(self.pending)
+            self.pending, self.pending_all, self.pending_saves = set(), False, 0
+        # The lock isn't held while writing: writing all entries of a LogDatabase compacts it, which has to take
+        # the compaction lock before the lock
+        try:
+            self.write(keys, self.durability == DURABILITY_PERIODIC)
+        except Exception:
+            # Keep the saves so the next flush writes them again
+            with self.lock:
+                self.pending.update(keys)
+                self.pending_all = self.pending_all or not keys
+            raise
+
+    def run_flusher(self):
+        while not self.closed:
+            self.flush_requested.wait(self.flush_interval)
+            self.flush_requested.clear()
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+                debug(f"Failed to write {self.path}. Trying again with the next batch.")
+
+    def close(self):
+        """Writes all pending saves and syncs them to disk."""
+        if self.closed:
+            return
+        self.closed = True
+        self.flush_requested.set()
+        if self.flusher:
+            self.flusher.join()
+        self.flush()
+        if self.unsynced:
+            self.sync()
 
     def has(self, key: str | bytes) -> bool:
         if not isinstance(key, (str, bytes)):
@@ -136,3 +270,214 @@ class Database:
         self.data.clear()
         if save:
             self.save()
+
+
+class LogDatabase(Database):
+    """
+    Database which appends one record per changed entry to a log file instead of rewriting the whole file.
+    Loading replays the log on top of the last snapshot. Once the log has grown by compact_after records,
+    it is compacted into a new snapshot in the background.
+    The snapshot uses the format of an unencrypted Database, so existing databases can be opened directly.
+    """
+
+    def __init__(self, path: str, compact_after: int = 1000, durability: str = DURABILITY_ALWAYS, flush_interval: float = 1.0,
+                 flush_after: int = 100):
+        self.log_path = path + ".log"
+        self.compacting_path = path + ".log.compacting"  # Log which is currently being compacted
+        self.compact_after = compact_after
+        self.log_records = 0
+        self.compacting = False
+        self.compaction_lock = threading.Lock()  # Only one snapshot is written at a time
+        super().__init__(path, durability=durability, flush_interval=flush_interval, flush_after=flush_after)
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.log_file = open(self.log_path, "a")
+
+        # A compaction was interrupted, finish it before the next compaction moves the log onto the old log
+        if Path(self.compacting_path).exists():
+            self.recover()
+
+    def load(self, path: str):
+        data = {}
+        if Path(path).exists():
+            with open(path, "r") as file:
+                data = {key: self.decode_entry(key, value) for key, value in json.loads(file.read()).items()}
+        for log_path in [self.compacting_path, self.log_path]:
+            if Path(log_path).exists():
+                self.replay(data, log_path)
+        return data
+
+    def replay(self, data: dict[str, Any], log_path: str):
+        with open(log_path, "rb+") as file:
+            valid_length = 0
+            for line in file:
+                if not line.endswith(b"\n"):
+                    # The last record wasn't written completely before a crash (even if it is valid JSON),
+                    # drop it so new records aren't appended to it
+                    file.truncate(valid_length)
+                    break
+                valid_length += len(line)
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    debug(f"Skipping a corrupted record in {log_path}.")
+                    continue
+                if record["op"] == "set":
+                    data[record["key"]] = self.decode_entry(record["key"], record["value"])
+                elif record["op"] == "delete":
+                    data.pop(record["key"], None)
+                self.log_records += 1
+
+    def write(self, keys: tuple[str, ...], sync: bool):
+        if not keys:
+            self.compact()
+            return
+
+        with self.lock:
+            for key in keys:
+                if key in self.data:
+                    record = {"op": "set", "key": key, "value": self.encode_entry(key, self.data[key])}
+                else:
+                    record = {"op": "delete", "key": key}
+                self.log_file.write(json.dumps(record) + "\n")
+            self.log_file.flush()
+            if sync:
+                os.fsync(self.log_file.fileno())
+            else:
+                self.unsynced = True
+            self.log_records += len(keys)
+
+            if self.log_records >= self.compact_after and not self.compacting:
+                self.compacting = True
+                threading.Thread(target=self.compact, daemon=True).start()
+
+    def recover(self):
+        """
+        Writes the snapshot of an interrupted compaction. The loaded entries include the records of the old log,
+        which is only deleted once they are in the snapshot. The current log is kept, replaying it again is harmless.
+        """
+        with self.compaction_lock:
+            with self.lock:
+                encoded = {key: self.encode_entry(key, value) for key, value in self.data.items()}
+            atomic_write(self.path, json.dumps(encoded, indent=4))
+            Path(self.compacting_path).unlink(missing_ok=True)
+
+    def compact(self):
+        """
+        Writes all entries into a new snapshot and starts a new log.
+        Only encoding the entries blocks writers, the snapshot itself is written without holding the lock.
+        Must not be called while holding the lock, as the compaction lock is always taken first.
+        """
+        with self.compaction_lock:
+            try:
+                with self.lock:
+                    self.compacting = True
+                    encoded = {key: self.encode_entry(key, value) for key, value in self.data.items()}
+                    self.log_file.close()
+                    try:
+                        self.rotate_log()
+                    finally:
+                        self.log_file = open(self.log_path, "a")
+                    self.log_records = 0
+
+                atomic_write(self.path, json.dumps(encoded, indent=4))
+                Path(self.compacting_path).unlink(missing_ok=True)
+            finally:
+                self.compacting = False
+
+    def rotate_log(self):
+        """Moves the log to the compacting log, which is deleted once the new snapshot is written."""
+        if not Path(self.log_path).exists():
+            return
+        if Path(self.compacting_path).exists():
+            # Writing the previous snapshot failed, so the records of its log aren't in a snapshot yet
+            with open(self.log_path, "rb") as log, open(self.compacting_path, "ab") as compacting_log:
+                shutil.copyfileobj(log, compacting_log)
+                compacting_log.flush()
+                os.fsync(compacting_log.fileno())
+            os.remove(self.log_path)
+        else:
+            os.replace(self.log_path, self.compacting_path)
+
+    def encode_entry(self, key: str, value: Any) -> Any:
+        """Encodes one entry for the snapshot and the log."""
+        return encode_database({key: value})[key]
+
+    def decode_entry(self, key: str, encoded: Any) -> Any:
+        return decode_database({key: encoded})[key]
+
+    def sync(self):
+        with self.lock:
+            os.fsync(self.log_file.fileno())
+            self.unsynced = False
+
+    def close(self):
+        super().close()
+        # Wait for a compaction in the background, otherwise the next start has to finish it
+        with self.compaction_lock, self.lock:
+            self.log_file.close()
+
+
+class Sealed:
+    """An entry of an EncryptedDatabase which hasn't been decrypted yet."""
+    __slots__ = ["encoded"]
+
+    def __init__(self, encoded: str):
+        self.encoded = encoded
+
+
+class EncryptedDatabase(LogDatabase):
+    """
+    LogDatabase which encrypts every entry on its own with AES-GCM, using the name of the entry as associated data.
+    Saving an entry only encrypts that entry, and entries are only decrypted when they are accessed for the first time.
+    Entries which were never accessed are written to new snapshots without decrypting them again.
+    """
+
+    def __init__(self, path: str, key_path: str, compact_after: int = 1000, durability: str = DURABILITY_ALWAYS,
+                 flush_interval: float = 1.0, flush_after: int = 100):
+        self.encryption_key: bytes = load_or_create_key(key_path)
+        super().__init__(path, compact_after, durability, flush_interval, flush_after)
+
+    def encode_entry(self, key: str, value: Any) -> Any:
+        if isinstance(value, Sealed):
+            return value.encoded
+        iv, cipher, tag = crypto_utils.aes_gcm_encrypt(self.encryption_key, serializer.encode_message({key: value}), key.encode())
+        return (iv + tag + cipher).hex()
+
+    def decode_entry(self, key: str, encoded: Any) -> Any:
+        return Sealed(encoded)
+
+    def unseal(self, key: str, sealed: Sealed) -> Any:
+        encrypted = bytes.fromhex(sealed.encoded)
+        iv, tag, cipher = encrypted[:12], encrypted[12:28], encrypted[28:]
+        return serializer.decode_message(crypto_utils.aes_gcm_decrypt(self.encryption_key, iv, cipher, key.encode(), tag))[key]
+
+    def get(self, key: str | bytes) -> Any:
+        key = key.decode() if isinstance(key, bytes) else key
+        while True:
+            value = super().get(key)
+            if not isinstance(value, Sealed):
+                return value
+            unsealed = self.unseal(key, value)
+            with self.lock:
+                # Another thread may have changed the entry while it was decrypted, its value must not be replaced
+                if self.data.get(key) is value:
+                    self.data[key] = unsealed
+                    return unsealed
+
+    def update(self, key: str | bytes, value: Any, save: bool = True):
+        self.get(key)
+        super().update(key, value, save)
+
+
+def migrate_database(source: Database, target: Database):
+    """
+    Copies all entries of the source database into the target database and deletes the source database
+    once the target database is written to disk.
+    """
+    for key in source.keys():
+        target.insert(key, source.get(key), save=False)
+    target.write((), True)
+    source.close()
+    for path in [source.path, source.path + ".log"]:
+        Path(path).unlink(missing_ok=True)
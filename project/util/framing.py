@@ -0,0 +1,161 @@
+import socket
+import struct
+import threading
+from typing import Optional
+
+from project.util import compression
+from project.util.compression import StreamCompressor, StreamDecompressor
+
+# Every message on the wire is prefixed with its length as an unsigned 32-bit big endian integer
+# The two highest bits of the length are flags telling how the payload is compressed
+HEADER = struct.Struct("!I")
+FLAG_ZLIB = 0x80000000
+FLAG_ZLIB_DICT = 0x40000000
+FLAGS = {compression.ZLIB: FLAG_ZLIB, compression.ZLIB_DICT: FLAG_ZLIB_DICT}
+LENGTH_MASK = 0x3FFFFFFF
+MAX_FRAME_SIZE = 4 * 1024 * 1024  # 4 MiB, large enough for big key bundles and offline batches
+RECV_SIZE = 65536
+
+
+class FrameError(Exception):
+    """Raised when a frame violates the wire protocol, e.g. because it is too large."""
+    pass
+
+
+def frame(payload: bytes | memoryview, max_frame_size: int = MAX_FRAME_SIZE, flags: int = 0) -> bytes:
+    """
+    Prefixes the payload with its length so the receiver can split the byte stream into messages again.
+    :param payload: The bytes to send
+    :param max_frame_size: The maximum allowed payload size
+    :param flags: The compression flag of the payload, if it is compressed
+    :return: The framed payload
+    """
+    if len(payload) > max_frame_size:
+        raise FrameError(f"Frame of {len(payload)} bytes exceeds the maximum frame size of {max_frame_size} bytes.")
+    return HEADER.pack(len(payload) | flags) + payload
+
+
+class FrameBuffer:
+    """
+    Reassembles frames from a byte stream.
+    TCP/TLS can split or merge writes, so a single read can contain several frames or only part of one.
+    Incomplete frames are kept until the rest arrives. Compressed frames are decompressed.
+    """
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+        self.decompressor: Optional[StreamDecompressor] = None
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """
+        Adds received bytes to the buffer and returns all frames that are complete now.
+        :param data: The received bytes
+        :return: The payloads of all completed frames in the order they were sent
+        """
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            (header,) = HEADER.unpack_from(self.buffer, offset)
+            length = header & LENGTH_MASK
+            if length > self.max_frame_size:
+                raise FrameError(f"Peer announced a frame of {length} bytes, the maximum is {self.max_frame_size} bytes.")
+            end = offset + HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            payload = bytes(self.buffer[offset + HEADER.size:end])
+            flags = header & ~LENGTH_MASK
+            frames.append(self.decompress(flags, payload) if flags else payload)
+            offset = end
+        del self.buffer[:offset]
+        return frames
+
+    def decompress(self, flags: int, payload: bytes) -> bytes:
+        mode = compression.ZLIB if flags == FLAG_ZLIB else compression.ZLIB_DICT if flags == FLAG_ZLIB_DICT else None
+        if mode is None:
+            raise FrameError(f"Unknown frame flags {flags:#x}.")
+        if self.decompressor is None:
+            self.decompressor = StreamDecompressor(mode)
+        elif self.decompressor.mode != mode:
+            raise FrameError("Peer changed the compression mode of the connection.")
+        try:
+            return self.decompressor.decompress(payload, self.max_frame_size)
+        except Exception as e:
+            raise FrameError(f"Couldn't decompress frame: {e}")
+
+
+class FramedSocket:
+    """
+    Wraps a connected socket and sends/receives whole frames.
+    Sending is serialized with a lock, as several threads may forward messages to the same client
+    and compressed frames have to be sent in the order they were compressed.
+    """
+
+    def __init__(self, sock, max_frame_size: int = MAX_FRAME_SIZE):
+        self.socket = sock
+        self.buffer = FrameBuffer(max_frame_size)
+        self.max_frame_size = max_frame_size
+        self.send_lock = threading.Lock()
+        self.compressor: Optional[StreamCompressor] = None
+
+    def enable_compression(self, mode: str):
+        """
+        Compresses all frames sent from now on with the given mode, if it is supported.
+        Frames received from the peer are decompressed regardless of this setting.
+        """
+        if mode in compression.SUPPORTED:
+            with self.send_lock:
+                self.compressor = StreamCompressor(mode)
+
+    def send_frame(self, payload: bytes | memoryview):
+        with self.send_lock:
+            flags = 0
+            if self.compressor:
+                compressed = self.compressor.compress(payload)
+                if compressed is not None:
+                    payload = compressed
+                    flags = FLAGS[self.compressor.mode]
+            self.socket.sendall(frame(payload, self.max_frame_size, flags))
+
+    def drain(self):
+        """Waits until the frames sent so far were handed to the operating system."""
+        # sendall of a normal socket only returns once everything was written
+        if hasattr(self.socket, "drain"):
+            self.socket.drain()
+
+    def recv_frames(self) -> Optional[list[bytes]]:
+        """
+        Reads from the socket until at least one frame is complete.
+        :return: The received frames or None if the connection was closed
+        """
+        while True:
+            data = self.socket.recv(RECV_SIZE)
+            if not data:
+                return None
+            # SSL sockets can hold already decrypted data which select doesn't report as readable
+            while hasattr(self.socket, "pending") and self.socket.pending():
+                data += self.socket.recv(RECV_SIZE)
+            frames = self.buffer.feed(data)
+            if frames:
+                return frames
+
+    def getpeername(self) -> tuple[str, int]:
+        return self.socket.getpeername()
+
+    def close(self):
+        self.socket.close()
+
+    def abort(self):
+        """
+        Shuts the connection down from another thread, e.g. because the peer doesn't read.
+        Sends which are blocked fail and the thread receiving from the peer sees the connection as closed.
+        """
+        if hasattr(self.socket, "abort"):
+            self.socket.abort()
+            return
+        try:
+            # Bypasses the SSL shutdown, which would have to write to the connection
+            socket.socket.shutdown(self.socket, socket.SHUT_RDWR)
+        except OSError:
+            pass
@@ -28,7 +28,17 @@ X3DH_REQUEST_KEYS = "x3dh_keys"
 
 RESET = "reset"
 
+OFFLINE_ACK = "offline_ack"
+
+# First byte of an encoded message. Messages in the old format are zlib streams, which start with 0x78.
+MESSAGE_VERSION = 1
+
 class Message:
+    """
+    A message consists of a small header (sender, receiver and type) and the encoded content.
+    Encoded messages start with the header, so routing a message only requires parsing the header.
+    The content is decoded the first time it is accessed via dict().
+    """
 
     def __init__(self, message: bytes, sender: str, receiver: str, type: str = MESSAGE):
         self.content = message
@@ -36,6 +46,7 @@ class Message:
         self.receiver = receiver
         self.type = type
         self.content_dict = None
+        self.raw: Optional[bytes] = None  # The bytes this message was decoded from, used to relay it unchanged
 
     def __str__(self):
         return f"{self.sender} -> {self.receiver}: {self.content} ({self.type})"
@@ -44,32 +55,66 @@ class Message:
         return self.__str__()
 
     def to_bytes(self) -> bytes:
-        from project.util.serializer.serializer import encode_message
-        return encode_message({
-            "content": self.content,
-            "sender": self.sender,
-            "receiver": self.receiver,
-            "type": self.type
-        })
+        """
+        Encodes the message as version byte, header fields (each prefixed with a one byte length) and content.
+        """
+        header = bytearray([MESSAGE_VERSION])
+        for field in (self.sender, self.receiver, self.type):
+            encoded = field.encode()
+            if len(encoded) > 255:
+                raise ValueError(f"Header field '{field}' is too long.")
+            header.append(len(encoded))
+            header += encoded
+        return bytes(header) + self.content
 
     def dict(self) -> dict[str, any]:
         from project.util.serializer.serializer import decode_message
-        if not self.content_dict:
+        if self.content_dict is None:
             self.content_dict = decode_message(self.content)
         return self.content_dict
 
     @staticmethod
     def from_bytes(data: bytes) -> Optional["Message"]:
-        from project.util.serializer.serializer import decode_message
+        """
+        Decodes the header of an encoded message. The content is only decoded when dict() is called.
+        :param data: The encoded message
+        :return: The message or None if the header couldn't be decoded
+        """
         try:
-            message = decode_message(data)
-            return Message(message["content"], message["sender"], message["receiver"], message["type"])
+            if data[0] != MESSAGE_VERSION:
+                return Message.from_legacy_bytes(data)
+
+            fields = []
+            offset = 1
+            for _ in range(3):
+                start = offset + 1
+                offset = start + data[offset]
+                if offset > len(data):
+                    raise ValueError("Message header is truncated.")
+                fields.append(data[start:offset].decode())
+
+            message = Message(data[offset:], *fields)
+            message.raw = data
+            return message
         except:
             print_exc()
             return None
 
+    @staticmethod
+    def from_legacy_bytes(data: bytes) -> "Message":
+        """Decodes a message encoded in the old format, where the whole message was one encoded dictionary."""
+        from project.util.serializer.serializer import decode_message
+        decoded = decode_message(data)
+        return Message(decoded["content"], decoded["sender"], decoded["receiver"], decoded["type"])
+
 
-def is_valid_message(message) -> bool:
+def is_valid_message(message, decode_content: bool = True) -> bool:
+    """
+    Checks if the message has valid header fields.
+    :param message: The message to check
+    :param decode_content: Whether the content has to be decodable as well, not required for messages which are only relayed
+    :return: Whether the message is valid
+    """
     if not message:
         return False
 
@@ -82,6 +127,9 @@ def is_valid_message(message) -> bool:
     if not utils.check_username(message.sender) or not utils.check_username(message.receiver):
         return False
 
+    if not decode_content:
+        return True
+
     try:
         message.dict()
         return True
@@ -1,4 +1,6 @@
 import os
+import struct
+import time
 from typing import Optional
 
 from ecdsa import VerifyingKey, SigningKey
@@ -7,8 +9,31 @@ from project.util import crypto_utils
 from project.util.crypto_utils import power_sk_vk, kdf_chain, generate_signature_key_pair
 from project.util.utils import debug
 
+MAX_SKIP = 1000  # The number of messages a single message may skip, so a message can't make us derive endless keys
+MAX_SKIPPED_KEYS = 2000
+SKIPPED_KEY_LIFETIME = 30 * 24 * 60 * 60  # Seconds until the key of a message which never arrived is deleted
+# A skipped key is stored as public key of the sender (compressed point), index, message key and creation time
+SKIPPED_KEY_FORMAT = struct.Struct(">33sI32sQ")
+
+# Binary layout of a state: version, flags, index and length of the chain key, followed by the chain key,
+# the keys which are set (x as 32 bytes, X and Y as compressed points) and the skipped keys
+STATE_VERSION = 1
+STATE_HEADER = struct.Struct(">BBQB")
+HAS_x = 0x01
+HAS_X = 0x02
+HAS_Y = 0x04
+LAST_SENDER_ME = 0x08
+PRIVATE_KEY_SIZE = 32
+PUBLIC_KEY_SIZE = 33
+
 
 class DoubleRatchetState:
+    """
+    State of a chat. The keys are kept as raw bytes when a state is loaded and only decoded when they are used,
+    so loading many chats doesn't parse any keys.
+    """
+    __slots__ = ["_x", "_x_key", "_X", "_X_key", "_Y", "_Y_key", "ck", "index", "last_sender", "skipped"]
+
     def __init__(self, root_key: bytes, x: Optional[SigningKey], X: Optional[VerifyingKey], Y: Optional[VerifyingKey] = None, initialized_by_me: bool = True):
         """
         To initialize the DRS as a first time sender, set Y to the recipient's public key and leave x and X as None.
@@ -19,20 +44,66 @@ class DoubleRatchetState:
         :param Y: The other person's public key
         :param initialized_by_me: Whether you are the one initializing the conversation
         """
+        # Every key is stored as raw bytes and/or as key object, whichever was needed so far
+        self._x: Optional[bytes] = None
+        self._X: Optional[bytes] = None
+        self._Y: Optional[bytes] = None
         self.x = x
         self.X = X
         self.Y = Y
         self.ck = root_key
         self.index = 0
         self.last_sender = "ME" if initialized_by_me else "THEM"
+        # Message keys of skipped messages by (public key of the sender, index), oldest first
+        self.skipped: dict[tuple[bytes, int], tuple[bytes, int]] = {}
+
+    @property
+    def x(self) -> Optional[SigningKey]:
+        if self._x_key is None and self._x is not None:
+            self._x_key = crypto_utils.decode_private_key(self._x)
+        return self._x_key
+
+    @x.setter
+    def x(self, key: Optional[SigningKey]):
+        self._x_key, self._x = key, None
+
+    @property
+    def X(self) -> Optional[VerifyingKey]:
+        if self._X_key is None and self._X is not None:
+            self._X_key = crypto_utils.decode_public_key(self._X)
+        return self._X_key
+
+    @X.setter
+    def X(self, key: Optional[VerifyingKey]):
+        self._X_key, self._X = key, None
 
+    @property
+    def Y(self) -> Optional[VerifyingKey]:
+        if self._Y_key is None and self._Y is not None:
+            self._Y_key = crypto_utils.decode_public_key(self._Y)
+        return self._Y_key
+
+    @Y.setter
+    def Y(self, key: Optional[VerifyingKey]):
+        self._Y_key, self._Y = key, None
+
+    def raw_keys(self) -> tuple[Optional[bytes], Optional[bytes], Optional[bytes]]:
+        """Returns x, X and Y as raw bytes. Keys which were changed since the last call are encoded once."""
+        if self._x is None and self._x_key is not None:
+            self._x = crypto_utils.encode_private_key(self._x_key)
+        if self._X is None and self._X_key is not None:
+            self._X = crypto_utils.encode_public_key(self._X_key)
+        if self._Y is None and self._Y_key is not None:
+            self._Y = crypto_utils.encode_public_key(self._Y_key)
+        return self._x, self._X, self._Y
 
     def compute_dh(self, Y: VerifyingKey):
         DH = power_sk_vk(self.x, Y)
         self.Y = Y
         return DH
 
-    def encrypt(self, plaintext: bytes) -> dict[str, bytes | VerifyingKey | int]:
+    def next_sending_key(self) -> tuple[bytes, int]:
+        """Advances the chain for a message sent by us and returns its message key and index."""
         if self.index == 0 or self.last_sender == "THEM":
             self.x, self.X = generate_signature_key_pair()
             DH = self.compute_dh(self.Y)
@@ -41,64 +112,190 @@ class DoubleRatchetState:
 
         mk, ck = kdf_chain(DH + self.ck)
         self.ck = ck
+        index = self.index
+        self.index += 1
+        self.last_sender = "ME"
+        return mk, index
+
+    def encrypt(self, plaintext: bytes) -> dict[str, bytes | VerifyingKey | int]:
+        mk, index = self.next_sending_key()
 
         # Encrypt message
         iv, cipher, tag = crypto_utils.aes_gcm_encrypt(mk, plaintext, b"AD")
-        message = {
+        return {
             "cipher": cipher,
             "iv": iv,
             "tag": tag,
-            "index": self.index,
+            "index": index,
             "X": self.X
         }
-        self.index += 1
-        self.last_sender = "ME"
-        return message
+
+    def encrypt_many(self, plaintexts: list[bytes]) -> list[dict[str, bytes | VerifyingKey | int]]:
+        """
+        Encrypts several messages, e.g. a burst of messages to the same user.
+        The chain advances once per message, every message has its own key.
+        """
+        keys = [self.next_sending_key() for _ in plaintexts]
+        encrypted = [crypto_utils.aes_gcm_encrypt(mk, plaintext, b"AD") for (mk, _), plaintext in zip(keys, plaintexts)]
+        return [
+            {"cipher": cipher, "iv": iv, "tag": tag, "index": index, "X": self.X}
+            for (_, index), (iv, cipher, tag) in zip(keys, encrypted)
+        ]
 
     def decrypt(self, message: dict[str, bytes | VerifyingKey | int]) -> bytes:
-        self.index = message["index"]
-        self.Y = message["X"]
+        """
+        Decrypts a message. Messages may arrive out of order: the keys of messages which are skipped by a later
+        message are stored until the skipped messages arrive.
+        The state is only changed if the message can be decrypted, so invalid messages don't break the chain.
+        :return: The plaintext or b"" if the message can't be decrypted
+        """
+        index, X = message["index"], message["X"]
+        iv, cipher, tag = message["iv"], message["cipher"], message["tag"]
+        self.evict_skipped()
 
-        if self.index == 0 or self.last_sender == "ME":
-            DH = self.compute_dh(self.Y)
-        else:
-            DH = b""
+        if index < self.index:
+            return self.decrypt_skipped(X, index, iv, cipher, tag)
+        if index - self.index > MAX_SKIP:
+            debug(f"Failed to decrypt message: it skips {index - self.index} messages.")
+            return b""
 
-        mk, ck = kdf_chain(DH + self.ck)
-        self.ck = ck
-        self.last_sender = "THEM"
+        # All messages since the last known one belong to the same turn of the sender, as they only create a new
+        # key pair after receiving a message. So only the first step of the turn includes a DH.
+        ck, last_sender, Y = self.ck, self.last_sender, self.Y
+        skipped_keys = []
+        for step in range(self.index, index + 1):
+            if step == 0 or last_sender == "ME":
+                DH = power_sk_vk(self.x, X)
+                Y = X
+            else:
+                DH = b""
+            mk, ck = kdf_chain(DH + ck)
+            last_sender = "THEM"
+            if step < index:
+                skipped_keys.append((step, mk))
 
-        iv, cipher, tag = message["iv"], message["cipher"], message["tag"]
-        self.index += 1
         try:
-            return crypto_utils.aes_gcm_decrypt(mk, iv, cipher, b"AD", tag)
+            plaintext = crypto_utils.aes_gcm_decrypt(mk, iv, cipher, b"AD", tag)
         except Exception as e:
             debug(f"Failed to decrypt message: {e}")
             return b""
 
+        self.ck, self.last_sender, self.Y, self.index = ck, last_sender, Y, index + 1
+        if skipped_keys:
+            encoded_X = crypto_utils.encode_public_key(X)
+            now = int(time.time())
+            for step, mk in skipped_keys:
+                self.skipped[(encoded_X, step)] = (mk, now)
+            self.evict_skipped()
+        return plaintext
+
+    def decrypt_many(self, messages: list[dict[str, bytes | VerifyingKey | int]]) -> list[bytes]:
+        """
+        Decrypts several messages, e.g. a burst of messages or the offline messages of a user.
+        Every message is authenticated before the state changes, so they are decrypted one after another.
+        :return: The plaintexts in the same order, b"" for messages which can't be decrypted
+        """
+        return [self.decrypt(message) for message in messages]
+
+    def decrypt_skipped(self, X: VerifyingKey, index: int, iv: bytes, cipher: bytes, tag: bytes) -> bytes:
+        """Decrypts a message which was skipped before. Its key is deleted afterwards, so it can't be replayed."""
+        entry = (crypto_utils.encode_public_key(X), index)
+        if entry not in self.skipped:
+            debug(f"Failed to decrypt message: no key for message {index}, it is either too old or a replay.")
+            return b""
+
+        try:
+            plaintext = crypto_utils.aes_gcm_decrypt(self.skipped[entry][0], iv, cipher, b"AD", tag)
+        except Exception as e:
+            debug(f"Failed to decrypt skipped message: {e}")
+            return b""
+        del self.skipped[entry]
+        return plaintext
+
+    def evict_skipped(self):
+        """Deletes the oldest skipped keys if there are too many or they are too old."""
+        expired = int(time.time()) - SKIPPED_KEY_LIFETIME
+        while self.skipped:
+            oldest = next(iter(self.skipped))
+            if len(self.skipped) <= MAX_SKIPPED_KEYS and self.skipped[oldest][1] >= expired:
+                break
+            del self.skipped[oldest]
+
+    def to_bytes(self) -> bytes:
+        """Encodes the state in the binary layout described at STATE_HEADER."""
+        x, X, Y = self.raw_keys()
+        flags = (HAS_x if x else 0) | (HAS_X if X else 0) | (HAS_Y if Y else 0) | (LAST_SENDER_ME if self.last_sender == "ME" else 0)
+        return b"".join([
+            STATE_HEADER.pack(STATE_VERSION, flags, self.index, len(self.ck)),
+            self.ck, x or b"", X or b"", Y or b"",
+            *(SKIPPED_KEY_FORMAT.pack(X, index, mk, created) for (X, index), (mk, created) in self.skipped.items())
+        ])
+
+    @staticmethod
+    def from_bytes(data: bytes | memoryview) -> "DoubleRatchetState":
+        """Decodes a state encoded with to_bytes. The keys are decoded when they are used for the first time."""
+        data = bytes(data)
+        version, flags, index, ck_length = STATE_HEADER.unpack_from(data)
+        if version != STATE_VERSION:
+            raise ValueError(f"Unknown version {version} of an encoded ratchet state.")
+
+        drs = DoubleRatchetState.__new__(DoubleRatchetState)
+        offset = STATE_HEADER.size
+        drs.ck = data[offset:offset + ck_length]
+        offset += ck_length
+        for slot, flag, size in [("_x", HAS_x, PRIVATE_KEY_SIZE), ("_X", HAS_X, PUBLIC_KEY_SIZE), ("_Y", HAS_Y, PUBLIC_KEY_SIZE)]:
+            setattr(drs, slot + "_key", None)
+            setattr(drs, slot, data[offset:offset + size] if flags & flag else None)
+            offset += size if flags & flag else 0
+        drs.index = index
+        drs.last_sender = "ME" if flags & LAST_SENDER_ME else "THEM"
+        drs.skipped = {(X, index): (mk, created) for X, index, mk, created in SKIPPED_KEY_FORMAT.iter_unpack(data[offset:])}
+        return drs
+
     def to_dict(self) -> dict[str, str | int | bool]:
+        x, X, Y = self.raw_keys()
         return {
-            "x": self.x.to_pem().hex() if self.x else None,
-            "X": self.X.to_pem().hex() if self.X else None,
-            "Y": self.Y.to_pem().hex() if self.Y else None,
+            "x": x.hex() if x else None,
+            "X": X.hex() if X else None,
+            "Y": Y.hex() if Y else None,
             "ck": self.ck.hex(),
             "index": self.index,
-            "last_sender": self.last_sender
+            "last_sender": self.last_sender,
+            "skipped": b"".join(SKIPPED_KEY_FORMAT.pack(X, index, mk, created) for (X, index), (mk, created) in self.skipped.items()).hex()
         }
 
     @staticmethod
     def from_dict(data: dict[str, str | int | bool]) -> "DoubleRatchetState":
         drs = DoubleRatchetState(
             root_key=bytes.fromhex(data["ck"]),
-            x=SigningKey.from_pem(bytes.fromhex(data["x"]).decode()) if data["x"] else None,
-            X=VerifyingKey.from_pem(bytes.fromhex(data["X"]).decode()) if data["X"] else None,
-            Y=VerifyingKey.from_pem(bytes.fromhex(data["Y"]).decode()) if data["Y"] else None,
+            x=decode_private_key(data["x"]) if data["x"] else None,
+            X=decode_public_key(data["X"]) if data["X"] else None,
+            Y=decode_public_key(data["Y"]) if data["Y"] else None,
             initialized_by_me=data["last_sender"] == "ME"
         )
         drs.index = data["index"]
+        skipped = bytes.fromhex(data.get("skipped", ""))  # States saved by older versions don't have skipped keys
+        for X, index, mk, created in SKIPPED_KEY_FORMAT.iter_unpack(skipped):
+            drs.skipped[(X, index)] = (mk, created)
         return drs
 
 
+# States saved by older versions contain the keys as hex encoded PEM
+PEM_HEX_PREFIX = b"-----".hex()
+
+
+def decode_private_key(encoded: str) -> SigningKey:
+    if encoded.startswith(PEM_HEX_PREFIX):
+        return crypto_utils.convert_private_key(SigningKey.from_pem(bytes.fromhex(encoded).decode()))
+    return crypto_utils.decode_private_key(bytes.fromhex(encoded))
+
+
+def decode_public_key(encoded: str) -> VerifyingKey:
+    if encoded.startswith(PEM_HEX_PREFIX):
+        return crypto_utils.convert_public_key(VerifyingKey.from_pem(bytes.fromhex(encoded).decode()))
+    return crypto_utils.decode_public_key(bytes.fromhex(encoded))
+
+
 if __name__ == "__main__":
     x, X = generate_signature_key_pair()
     y, Y = generate_signature_key_pair()
@@ -132,6 +329,10 @@ if __name__ == "__main__":
     print(rs_A.decrypt(encrypted8))
 
     encrypted9 = rs_A.encrypt(b"At the park")
+    encrypted10 = rs_A.encrypt(b"See you there")
 
+    # Messages which arrive out of order are decrypted with the stored keys of the skipped messages
+    print(rs_B.decrypt(encrypted10))
+    rs_B = DoubleRatchetState.from_dict(rs_B.to_dict())
     print(rs_B.decrypt(encrypted9))
 
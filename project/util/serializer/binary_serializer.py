@@ -0,0 +1,169 @@
+import struct
+from typing import Any, Callable, Optional
+
+from project.util.serializer.codec_registry import CodecRegistry, SerializationError
+
+# First byte of a message encoded with this serializer. The old format is a zlib stream, which starts with 0x78.
+BINARY_VERSION = 2
+
+TAG_NONE = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3
+TAG_FLOAT = 4
+TAG_STR = 5
+TAG_BYTES = 6
+TAG_LIST = 7
+TAG_DICT = 8
+FIRST_CUSTOM_TAG = 16  # Tags below are reserved for the built-in types
+
+FLOAT = struct.Struct("!d")
+
+
+REGISTRY = CodecRegistry("binary")
+
+
+def register_codec(tag: int, value_type: type, encode: Optional[Callable[[Any], bytes]], decode: Optional[Callable[[bytes], Any]],
+                   decode_only: bool = False, encode_only: bool = False):
+    """
+    Registers a codec for a type that isn't supported natively.
+    :param tag: The tag identifying the type on the wire, has to be unique and at least FIRST_CUSTOM_TAG
+    :param value_type: The type handled by the codec
+    :param encode: Function turning a value into bytes
+    :param decode: Function turning the bytes back into a value
+    :param decode_only: Whether the codec is only used to decode an older encoding of the type
+    :param encode_only: Whether the codec encodes another type with an already registered tag
+    """
+    if not FIRST_CUSTOM_TAG <= tag <= 255:
+        raise ValueError(f"Tag {tag} is reserved or out of range.")
+    REGISTRY.register(tag, value_type, encode, decode, decode_only, encode_only)
+
+
+def write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data: bytes, offset: int) -> tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        if offset >= len(data) or shift > 63:
+            raise SerializationError("Invalid length.")
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+
+def write_blob(out: bytearray, tag: int, blob: bytes):
+    out.append(tag)
+    write_varint(out, len(blob))
+    out += blob
+
+
+def read_blob(data: bytes, offset: int) -> tuple[bytes, int]:
+    length, offset = read_varint(data, offset)
+    end = offset + length
+    if end > len(data):
+        raise SerializationError("Encoded data is truncated.")
+    return data[offset:end], end
+
+
+def encode_value(out: bytearray, value: Any):
+    value_type = type(value)
+    if value is None:
+        out.append(TAG_NONE)
+    elif value_type is bool:
+        out.append(TAG_TRUE if value else TAG_FALSE)
+    elif value_type is int:
+        write_blob(out, TAG_INT, value.to_bytes(value.bit_length() // 8 + 1, "big", signed=True))
+    elif value_type is float:
+        out.append(TAG_FLOAT)
+        out += FLOAT.pack(value)
+    elif value_type is str:
+        write_blob(out, TAG_STR, value.encode())
+    elif value_type is bytes:
+        write_blob(out, TAG_BYTES, value)
+    elif value_type is list:
+        out.append(TAG_LIST)
+        write_varint(out, len(value))
+        for item in value:
+            encode_value(out, item)
+    elif value_type is dict:
+        out.append(TAG_DICT)
+        write_varint(out, len(value))
+        for key, item in value.items():
+            if type(key) is not str:
+                raise SerializationError(f"Dictionary keys must be strings, got {type(key).__name__}.")
+            encoded_key = key.encode()
+            write_varint(out, len(encoded_key))
+            out += encoded_key
+            encode_value(out, item)
+    else:
+        codec = REGISTRY.for_type(value_type)
+        write_blob(out, codec.key, codec.encode(value))
+
+
+def decode_value(data: bytes, offset: int) -> tuple[Any, int]:
+    if offset >= len(data):
+        raise SerializationError("Encoded data is truncated.")
+    tag = data[offset]
+    offset += 1
+    if tag == TAG_NONE:
+        return None, offset
+    elif tag == TAG_FALSE:
+        return False, offset
+    elif tag == TAG_TRUE:
+        return True, offset
+    elif tag == TAG_INT:
+        blob, offset = read_blob(data, offset)
+        return int.from_bytes(blob, "big", signed=True), offset
+    elif tag == TAG_FLOAT:
+        if offset + FLOAT.size > len(data):
+            raise SerializationError("Encoded data is truncated.")
+        return FLOAT.unpack_from(data, offset)[0], offset + FLOAT.size
+    elif tag == TAG_STR:
+        blob, offset = read_blob(data, offset)
+        return blob.decode(), offset
+    elif tag == TAG_BYTES:
+        return read_blob(data, offset)
+    elif tag == TAG_LIST:
+        length, offset = read_varint(data, offset)
+        items = []
+        for _ in range(length):
+            item, offset = decode_value(data, offset)
+            items.append(item)
+        return items, offset
+    elif tag == TAG_DICT:
+        length, offset = read_varint(data, offset)
+        decoded = {}
+        for _ in range(length):
+            key, offset = read_blob(data, offset)
+            decoded[key.decode()], offset = decode_value(data, offset)
+        return decoded, offset
+
+    codec = REGISTRY.for_key(tag)
+    blob, offset = read_blob(data, offset)
+    return codec.decode(blob), offset
+
+
+def encode(value: Any) -> bytes:
+    """Encodes a value into the versioned binary format."""
+    out = bytearray([BINARY_VERSION])
+    encode_value(out, value)
+    return bytes(out)
+
+
+def decode(data: bytes) -> Any:
+    """Decodes a value encoded with encode()."""
+    if not data or data[0] != BINARY_VERSION:
+        raise SerializationError("Data isn't encoded in the binary format.")
+    value, offset = decode_value(data, 1)
+    if offset != len(data):
+        raise SerializationError("Encoded data has trailing bytes.")
+    return value
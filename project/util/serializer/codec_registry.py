@@ -0,0 +1,86 @@
+from typing import Any, Callable, Hashable, NamedTuple, Optional
+
+
+class SerializationError(ValueError):
+    """Raised when a value can't be encoded or encoded data can't be decoded."""
+    pass
+
+
+class UnknownTypeError(SerializationError):
+    """Raised when no codec is registered for the type of a value (or any of its base classes)."""
+    pass
+
+
+class UnknownKeyError(SerializationError):
+    """Raised when encoded data references a prefix/tag no codec is registered for."""
+    pass
+
+
+class Codec(NamedTuple):
+    key: Hashable  # The prefix or tag identifying the type in encoded data
+    type: type
+    encode: Callable[[Any], Any]
+    decode: Callable[[Any], Any]
+
+
+class CodecRegistry:
+    """
+    Maps types and prefixes/tags to codecs in constant time.
+    Subclasses of registered types use the codec of their closest registered base class.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.by_key: dict[Hashable, Codec] = {}
+        self.registered: dict[type, Codec] = {}
+        self.by_type: dict[type, Codec] = {}  # Registered types and already resolved subclasses
+
+    def register(self, key: Hashable, value_type: type, encode: Optional[Callable[[Any], Any]], decode: Optional[Callable[[Any], Any]],
+                 decode_only: bool = False, encode_only: bool = False) -> Codec:
+        """
+        Registers a codec.
+        :param key: The prefix/tag identifying the type in encoded data, has to be unique
+        :param value_type: The type handled by the codec
+        :param encode: Function encoding a value
+        :param decode: Function decoding an encoded value
+        :param decode_only: Whether the codec is only used for decoding, e.g. to read an older encoding of a type
+        :param encode_only: Whether the codec only encodes another type with an already registered prefix/tag,
+        e.g. equivalent types of different libraries. The codec registered first decodes the prefix/tag.
+        :return: The registered codec
+        """
+        if encode_only:
+            if key not in self.by_key:
+                raise ValueError(f"{self.name}: {key!r} has to be registered before it can be used for {value_type.__name__}.")
+        elif key in self.by_key:
+            raise ValueError(f"{self.name}: {key!r} is already registered for {self.by_key[key].type.__name__}.")
+        codec = Codec(key, value_type, encode, decode if decode else self.by_key[key].decode)
+        if not encode_only:
+            self.by_key[key] = codec
+        if decode_only:
+            return codec
+        self.registered[value_type] = codec
+        # Subclasses resolved earlier might have a closer base class now
+        self.by_type = dict(self.registered)
+        return codec
+
+    def for_type(self, value_type: type) -> Codec:
+        codec = self.by_type.get(value_type)
+        if codec is None:
+            for base in value_type.__mro__[1:]:
+                codec = self.registered.get(base)
+                if codec is not None:
+                    break
+            else:
+                # Classes registered with an abstract base class don't have it in their MRO
+                codec = next((codec for registered_type, codec in self.registered.items()
+                              if registered_type is not object and issubclass(value_type, registered_type)), None)
+                if codec is None:
+                    raise UnknownTypeError(f"{self.name}: No codec registered for type {value_type.__name__}.")
+            self.by_type[value_type] = codec
+        return codec
+
+    def for_key(self, key: Hashable) -> Codec:
+        codec = self.by_key.get(key)
+        if codec is None:
+            raise UnknownKeyError(f"{self.name}: Unknown prefix/tag {key!r}.")
+        return codec
@@ -2,7 +2,8 @@ import json
 import zlib
 from typing import Any
 
-from project.util.serializer.serializer_type_map import type_for_prefix, TYPE_MAP
+from project.util.serializer import binary_serializer
+from project.util.serializer.serializer_type_map import encode_prefixed, decode_prefixed
 
 
 def compress(value: bytes) -> bytes:
@@ -16,14 +17,16 @@ def decompress(value: bytes) -> bytes:
 
 
 def encode_message(message: dict[str, Any]) -> bytes:
+    return binary_serializer.encode(message)
+
+
+def encode_legacy_message(message: dict[str, Any]) -> bytes:
+    """Encodes a message in the old JSON + hex + zlib format. Only used to compare the formats."""
     return compress(json.dumps(encode_dict(message)).encode())
 
 
 def encode_value(value: Any) -> str:
-    value_type = type(value)
-    prefix, encode, _ = TYPE_MAP.get(value_type, ("U", lambda x: json.dumps(x), lambda x: json.loads(x)))
-
-    return f"{prefix}:{encode(value)}"
+    return encode_prefixed(value)
 
 
 def encode_dict(message: dict[str, Any]) -> dict[str, str]:
@@ -35,15 +38,18 @@ def encode_dict(message: dict[str, Any]) -> dict[str, str]:
 
 
 def decode_message(encoded: bytes) -> dict[str, Any]:
+    if encoded[:1] == bytes([binary_serializer.BINARY_VERSION]):
+        return binary_serializer.decode(encoded)
+    return decode_legacy_message(encoded)
+
+
+def decode_legacy_message(encoded: bytes) -> dict[str, Any]:
+    """Decodes a message in the old JSON + hex + zlib format, e.g. from databases written by older versions."""
     return decode_dict(json.loads(decompress(encoded).decode()))
 
 
 def decode_value(encoded: str) -> Any:
-    prefix, value = encoded.split(":", 1)
-    value_type = type_for_prefix(prefix)
-    _, _, decode = TYPE_MAP.get(value_type, ("U", lambda x: json.dumps(x), lambda x: json.loads(x)))
-
-    return decode(value)
+    return decode_prefixed(encoded)
 
 
 def decode_dict(encoded: dict[str, str]) -> dict[str, Any]:
@@ -1,5 +1,6 @@
 import json
 from types import NoneType
+from typing import Any
 
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.ec import EllipticCurvePublicKey, EllipticCurvePrivateKey
@@ -7,40 +8,36 @@ from ecdsa import VerifyingKey, SigningKey
 from ecdsa.curves import NIST256p as CURVE
 from ecdsa.ellipticcurve import Point
 
+from project.util import crypto_utils
 from project.util.message import Message
 from project.util.ratchet import DoubleRatchetState
+from project.util.serializer import binary_serializer
+from project.util.serializer.codec_registry import CodecRegistry
+
+
+PREFIXES = CodecRegistry("prefix")
+
+
+def encode_prefixed(value: Any) -> str:
+    codec = PREFIXES.for_type(type(value))
+    return f"{codec.key}:{codec.encode(value)}"
+
+
+def decode_prefixed(encoded: str) -> Any:
+    prefix, _, value = encoded.partition(":")
+    return PREFIXES.for_key(prefix).decode(value)
 
 
 def encode_list(value: list) -> str:
-    string = ""
-    for item in value:
-        item_type = type(item)
-        prefix, encode, _ = TYPE_MAP.get(item_type, ("U", lambda x: json.dumps(x), lambda x: json.loads(x)))
-        encoded = encode(item)
-        string += f"{prefix}:{encoded};"
-    return string
+    return "".join([f"{encode_prefixed(item)};" for item in value])
 
 
 def decode_list(encoded: str) -> list:
-    decoded = []
-    for item in encoded.split(";"):
-        if not item:
-            continue
-        prefix, value = item.split(":", 1)
-        value_type = type_for_prefix(prefix)
-        _, _, decode = TYPE_MAP.get(value_type, ("U", lambda x: json.dumps(x), lambda x: json.loads(x)))
-        decoded.append(decode(value))
-    return decoded
+    return [decode_prefixed(item) for item in encoded.split(";") if item]
 
 
 def encode_dict(message: dict[str, any]) -> str:
-    string = ""
-    for key, value in message.items():
-        value_type = type(value)
-        prefix, encode, _ = TYPE_MAP.get(value_type, ("U", lambda x: json.dumps(x), lambda x: json.loads(x)))
-        encoded = encode(value)
-        string += f"{key}:{prefix}:{encoded}|"
-    return string
+    return "".join([f"{key}:{encode_prefixed(value)}|" for key, value in message.items()])
 
 
 def decode_dict(encoded: str) -> dict[str, any]:
@@ -48,51 +45,41 @@ def decode_dict(encoded: str) -> dict[str, any]:
     for item in encoded.split("|"):
         if not item:
             continue
-        key, item = item.split(":", 1)
-        prefix, value = item.split(":", 1)
-        value_type = type_for_prefix(prefix)
-        _, _, decode = TYPE_MAP.get(value_type, ("U", lambda x: json.dumps(x), lambda x: json.loads(x)))
-        decoded[key] = decode(value)
+        key, _, value = item.partition(":")
+        decoded[key] = decode_prefixed(value)
     return decoded
 
 
-def type_for_prefix(prefix):
-    try:
-        return [t for t, (p, _, _) in TYPE_MAP.items() if p == prefix][0]
-    except IndexError:
-        print(f"Unknown type prefix: {prefix}")
-
-
-TYPE_MAP = {
-    NoneType: ("N", lambda value: "", lambda encoded: None),
-    str: ("S", lambda value: value, lambda encoded: encoded),
-    bool: ("B", lambda value: str(int(value)), lambda encoded: bool(int(encoded))),
-    int: ("I", lambda value: str(value), lambda encoded: int(encoded)),
-    bytes: ("Y", lambda value: value.hex(), lambda encoded: bytes.fromhex(encoded)),
-    SigningKey: (
-        "SK", lambda value: value.to_pem().hex(), lambda encoded: SigningKey.from_pem(bytes.fromhex(encoded).decode())),
-    VerifyingKey: (
-        "VK", lambda value: value.to_pem().hex(), lambda encoded: VerifyingKey.from_pem(bytes.fromhex(encoded).decode())),
-    EllipticCurvePrivateKey: (
-        "ECSK",
-        lambda value: value.private_bytes(
-            encoding=serialization.Encoding.DER,
-            format=serialization.PrivateFormat.Raw,
-            encryption_algorithm=serialization.NoEncryption()
-        ).hex(),
-        lambda encoded: serialization.load_der_private_key(bytes.fromhex(encoded), password=None)
-    ),
-    EllipticCurvePublicKey: (
-        "ECPK",
-        lambda value: value.public_bytes(
-            encoding=serialization.Encoding.DER,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        ).hex(),
-        lambda encoded: serialization.load_der_public_key(bytes.fromhex(encoded))
-    ),
-    Point: ("P", lambda value: value.to_bytes().hex(), lambda encoded: Point.from_bytes(bytes.fromhex(encoded), CURVE)),
-    Message: ("M", lambda value: value.to_bytes().hex(), lambda encoded: Message.from_bytes(bytes.fromhex(encoded))),
-    DoubleRatchetState: ("DRS", lambda value: encode_dict(value.to_dict()), lambda encoded: DoubleRatchetState.from_dict(decode_dict(encoded))),
-    dict: ("D", encode_dict, decode_dict),
-    list: ("L", encode_list, decode_list)
-}
+# Codecs of the prefix format, which is used for the JSON databases
+# Values of types without a codec are stored as JSON with the prefix "U"
+PREFIXES.register("N", NoneType, lambda value: "", lambda encoded: None)
+PREFIXES.register("S", str, lambda value: value, lambda encoded: encoded)
+PREFIXES.register("B", bool, lambda value: str(int(value)), lambda encoded: bool(int(encoded)))
+PREFIXES.register("I", int, lambda value: str(value), lambda encoded: int(encoded))
+PREFIXES.register("Y", bytes, lambda value: value.hex(), lambda encoded: bytes.fromhex(encoded))
+# Keys of every crypto provider use the same codecs and are decoded as keys of the selected provider
+PREFIXES.register("SKR", SigningKey, lambda value: crypto_utils.encode_private_key(value).hex(), lambda encoded: crypto_utils.decode_private_key(bytes.fromhex(encoded)))
+PREFIXES.register("SKR", EllipticCurvePrivateKey, lambda value: crypto_utils.encode_private_key(value).hex(), None, encode_only=True)
+PREFIXES.register("SK", SigningKey, None, lambda encoded: crypto_utils.convert_private_key(SigningKey.from_pem(bytes.fromhex(encoded).decode())), decode_only=True)
+PREFIXES.register("VKC", VerifyingKey, lambda value: crypto_utils.encode_public_key(value).hex(), lambda encoded: crypto_utils.decode_public_key(bytes.fromhex(encoded)))
+PREFIXES.register("VKC", EllipticCurvePublicKey, lambda value: crypto_utils.encode_public_key(value).hex(), None, encode_only=True)
+PREFIXES.register("VK", VerifyingKey, None, lambda encoded: crypto_utils.convert_public_key(VerifyingKey.from_pem(bytes.fromhex(encoded).decode())), decode_only=True)
+PREFIXES.register("ECSK", EllipticCurvePrivateKey, None, lambda encoded: crypto_utils.convert_private_key(serialization.load_der_private_key(bytes.fromhex(encoded), password=None)), decode_only=True)
+PREFIXES.register("ECPK", EllipticCurvePublicKey, None, lambda encoded: crypto_utils.convert_public_key(serialization.load_der_public_key(bytes.fromhex(encoded))), decode_only=True)
+PREFIXES.register("P", Point, lambda value: value.to_bytes().hex(), lambda encoded: Point.from_bytes(bytes.fromhex(encoded), CURVE))
+PREFIXES.register("M", Message, lambda value: value.to_bytes().hex(), lambda encoded: Message.from_bytes(bytes.fromhex(encoded)))
+PREFIXES.register("DRSB", DoubleRatchetState, lambda value: value.to_bytes().hex(), lambda encoded: DoubleRatchetState.from_bytes(bytes.fromhex(encoded)))
+PREFIXES.register("DRS", DoubleRatchetState, None, lambda encoded: DoubleRatchetState.from_dict(decode_dict(encoded)), decode_only=True)
+PREFIXES.register("D", dict, encode_dict, decode_dict)
+PREFIXES.register("L", list, encode_list, decode_list)
+PREFIXES.register("U", object, json.dumps, json.loads)
+
+
+# Codecs of the binary format for types that aren't supported natively
+binary_serializer.register_codec(20, Point, lambda value: value.to_bytes(), lambda encoded: Point.from_bytes(encoded, CURVE))
+binary_serializer.register_codec(21, Message, lambda value: value.to_bytes(), lambda encoded: Message.from_bytes(encoded))
+binary_serializer.register_codec(23, VerifyingKey, crypto_utils.encode_public_key, lambda encoded: crypto_utils.decode_public_key(bytes(encoded)))
+binary_serializer.register_codec(23, EllipticCurvePublicKey, crypto_utils.encode_public_key, None, encode_only=True)
+binary_serializer.register_codec(24, SigningKey, crypto_utils.encode_private_key, lambda encoded: crypto_utils.decode_private_key(bytes(encoded)))
+binary_serializer.register_codec(24, EllipticCurvePrivateKey, crypto_utils.encode_private_key, None, encode_only=True)
+binary_serializer.register_codec(25, DoubleRatchetState, lambda value: value.to_bytes(), DoubleRatchetState.from_bytes)
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from ecdsa import VerifyingKey, SigningKey
 
 from project.util import crypto_utils
@@ -18,17 +20,22 @@ def x3dh_key_reaction(IPK_A: VerifyingKey, EPK_A: VerifyingKey, ik: SigningKey,
     DH4 = crypto_utils.power_sk_vk(ok, EPK_A)
     return crypto_utils.hkdf_extract(salt=None, input_key_material=DH1 + DH2 + DH3 + DH4)
 
-def generate_initial_x3dh_keys():
-    ik, IPK = crypto_utils.generate_signature_key_pair()
-    sk, SPK = crypto_utils.generate_signature_key_pair()
-    one_time_prekeys = crypto_utils.generate_one_time_pre_keys(5)
+def generate_initial_x3dh_keys(key_pairs: Optional[list[tuple[SigningKey, VerifyingKey]]] = None):
+    """
+    Generates the identity key, the signed prekey and five one-time prekeys.
+    :param key_pairs: Pre-generated key pairs which are used in this order, missing key pairs are generated
+    """
+    key_pairs = list(key_pairs or [])
+    key_pairs += crypto_utils.generate_one_time_pre_keys(max(0, 7 - len(key_pairs)))
+    (ik, IPK), (sk, SPK) = key_pairs[0], key_pairs[1]
+    one_time_prekeys = key_pairs[2:7]
 
     return {
         "ik": ik,
         "IPK": IPK,
         "sk": sk,
         "SPK": SPK,
-        "sigma": crypto_utils.ecdsa_sign(SPK.to_pem(), ik),
+        "sigma": crypto_utils.ecdsa_sign(crypto_utils.public_key_pem(SPK), ik),
         "oks": [ok for ok, _ in one_time_prekeys],
         "OPKs": [OPK for _, OPK in one_time_prekeys]
     }
\ No newline at end of file